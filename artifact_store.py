@@ -0,0 +1,103 @@
+#### Columnar artifact store for the pipeline outputs
+
+# Every stage output (playgrounds_by_zip, nyc_bracket_level, zip_income, the correlation tables)
+# is saved as an Arrow IPC file (or Parquet) instead of only a csv. Column names like
+# ('N1','sum') are flattened to 'N1__sum' for the file and the original labels (and label
+# indexes) are kept in the schema metadata, so loading gives back the exact same frame. Arrow
+# files are uncompressed and read through a memory map, load_table is zero copy (the columns
+# point straight into the page cache) instead of parsing the file again. load converts to numpy
+# backed columns, which copies every column; load(name,zero_copy=True) keeps the Arrow buffers
+# (pd.ArrowDtype columns) so the frame is still backed by the memory map.
+
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+ARTIFACT_DIR='artifacts'
+METADATA_KEY=b'lodha.columns'
+
+
+# Flat string name for every column label, tuples are joined with '__' (empty levels dropped)
+def flatten_columns(columns):
+    names=[]
+    for label in columns:
+        if isinstance(label,tuple):
+            name='__'.join(str(level) for level in label if level!='')
+        else:
+            name=str(label)
+        while name in names:        # ('a','') and 'a' would both become 'a'
+            name+='_'
+        names.append(name)
+    return names
+
+
+def _encode_labels(labels):
+    return {'multi':isinstance(labels,pd.MultiIndex),
+            'names':list(labels.names),
+            'labels':[list(label) if isinstance(label,tuple) else label for label in labels]}
+
+
+def _decode_labels(info):
+    if info['multi']:
+        return pd.MultiIndex.from_tuples([tuple(label) for label in info['labels']],names=info['names'])
+    return pd.Index([tuple(label) if isinstance(label,list) else label for label in info['labels']],name=info['names'][0],tupleize_cols=False)
+
+
+class ArtifactStore:
+
+    def __init__(self,root=ARTIFACT_DIR,format='arrow'):
+        self.root=root
+        self.format=format          # 'arrow' (memory mappable) or 'parquet' (compressed)
+        os.makedirs(root,exist_ok=True)
+
+    def path(self,name,format=None):
+        return os.path.join(self.root,name+('.arrow' if (format or self.format)=='arrow' else '.parquet'))
+
+    def save(self,name,frame):
+        flat=frame.copy(deep=False)
+        flat.columns=flatten_columns(frame.columns)
+        labels={'columns':_encode_labels(frame.columns)}
+
+        # Label indexes (the metric names of a correlation table) can mix strings, tuples and
+        # numbers which Arrow cannot type, they are kept in the metadata next to the column labels
+        if isinstance(frame.index,pd.MultiIndex) or frame.index.dtype==object:
+            labels['index']=_encode_labels(frame.index)
+            flat=flat.reset_index(drop=True)
+
+        table=pa.Table.from_pandas(flat)
+        metadata=dict(table.schema.metadata or {})
+        metadata[METADATA_KEY]=json.dumps(labels).encode()
+        table=table.replace_schema_metadata(metadata)
+
+        path=self.path(name)
+        tmp=path+'.tmp'
+        if self.format=='arrow':
+            feather.write_feather(table,tmp,compression='uncompressed')
+        else:
+            pq.write_table(table,tmp)
+        os.replace(tmp,path)         # Readers never see a half written file
+        return path
+
+    def load_table(self,name):
+        if os.path.exists(self.path(name,'arrow')):
+            with pa.memory_map(self.path(name,'arrow'),'r') as source:
+                return pa.ipc.open_file(source).read_all()
+        return pq.read_table(self.path(name,'parquet'),memory_map=True)
+
+    def load(self,name,zero_copy=False):
+        table=self.load_table(name)
+        frame=table.to_pandas(types_mapper=pd.ArrowDtype) if zero_copy else table.to_pandas()
+        raw=(table.schema.metadata or {}).get(METADATA_KEY)
+        if raw is not None:
+            labels=json.loads(raw)
+            frame.columns=_decode_labels(labels['columns'])
+            if 'index' in labels:
+                frame.index=_decode_labels(labels['index'])
+        return frame
+
+    def exists(self,name):
+        return os.path.exists(self.path(name,'arrow')) or os.path.exists(self.path(name,'parquet'))
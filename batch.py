@@ -0,0 +1,167 @@
+#### Batch runs over SOI years, regions and park sources
+
+# The pipeline covers one tax year (16zpallagi.csv) and the five NYC counties. The batch driver
+# runs the same playground / income analysis for every combination of
+#
+#   year    - SOI tax year, the income file is soi_url(year) or a local path template
+#   region  - zip code to county file, the counties to keep, the zip code geojson and the
+#             correlation slices (see REGIONS)
+#   parks   - parks and playgrounds sources (see PARKS)
+#
+# The inputs are read once in the parent process and written to the artifact store as Arrow files:
+# one income table per year (only the zip codes of the regions), one zip code table per region
+# and the parks / playgrounds columns the stages use. Every combination then runs in a process
+# pool and the workers load those files with store.load(name,zero_copy=True): the columns stay
+# Arrow buffers over the memory map, so the file pages are read once into the page cache and
+# shared by the workers instead of every worker holding its own numpy copy of the inputs (the
+# stages still allocate their own filtered and grouped frames), and nothing big is pickled to
+# them. Only the per zip code result table and the correlations come back, and are merged into
+# two longitudinal tables (one row per year, region, parks source and zip code / metric).
+#
+# Usage: python batch.py --years 2014 2015 2016 --regions nyc --workers 4
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from io import StringIO
+
+import pandas as pd
+
+import data_sources
+import income_ingest
+import pipeline
+from artifact_store import ArtifactStore, flatten_columns
+
+BATCH_DIR=os.path.join('artifacts','batch')
+
+# Other metros use the same layout, e.g. {'buffalo':{'zips_source':<same NY file>,'counties':['Erie','Niagara'],
+# 'geojson':'buffalo_zip_code.geojson','slices':{'All_Buffalo':[]}}}
+REGIONS={
+    'nyc':{'zips_source':data_sources.SOURCES['ny_zips']['url'],
+           'counties':pipeline.DEFAULT_CONFIG['counties'],
+           'geojson':pipeline.DEFAULT_CONFIG['geojson'],
+           'slices':pipeline.DEFAULT_CONFIG['slices']},
+}
+PARKS={
+    'nyc_dpr':{'parks_source':data_sources.SOURCES['parks']['url'],
+               'playgrounds_source':data_sources.SOURCES['playgrounds']['url']},
+}
+PARK_COLUMNS=['Prop_ID','Zip']
+PLAYGROUND_COLUMNS=['Prop_ID','Playground_ID','School_ID','lat','lon']
+ZIP_COLUMNS=['County Name','ZIP Code']
+CORRELATIONS={'income_playground_correl_no_filters':'none','outliers_excluding_correlation':'outliers_excluded'}
+
+
+# Every (year, region, parks) combination
+def job_matrix(years,regions,parks):
+    return [{'year':year,'region':region,'parks':park} for year in years for region in regions for park in parks]
+
+
+def _as_text(frame,columns):
+    # Mixed id columns (numbers and strings) can not be typed by Arrow
+    frame=frame[columns].copy()
+    for column in frame.columns:
+        if frame[column].dtype==object:
+            frame[column]=frame[column].where(frame[column].isna(),frame[column].astype(str))
+    return frame
+
+
+# Reads every input once and stores it for the workers. income_source is a url or path template
+# with {year} (default: the IRS SOI file of the year)
+def prepare_inputs(jobs,store,sources,regions=REGIONS,parks=PARKS,income_source=None,verbose=True):
+    region_zips=[]
+    for name in sorted({job['region'] for job in jobs}):
+        region=regions[name]
+        zips=pd.read_csv(sources.fetch('zips_'+name,region['zips_source']))[ZIP_COLUMNS]
+        zips=zips[zips['County Name'].str.contains('|'.join(region['counties']))]
+        store.save('zips_'+name,zips.reset_index(drop=True))
+        region_zips.append(zips['ZIP Code'])
+    wanted=pd.concat(region_zips).unique()
+
+    for year in sorted({job['year'] for job in jobs}):
+        source=income_source.format(year=year) if income_source else income_ingest.soi_url(year)
+        income,_=income_ingest.read_income(sources.fetch('income_{}'.format(year),source),zips=wanted,verbose=verbose)
+        store.save('income_{}'.format(year),income)
+
+    for name in sorted({job['parks'] for job in jobs}):
+        spec=parks[name]
+        store.save('parks_'+name,_as_text(pd.read_json(sources.fetch('parks_'+name,spec['parks_source'])),PARK_COLUMNS))
+        store.save('playgrounds_'+name,_as_text(pd.read_json(sources.fetch('playgrounds_'+name,spec['playgrounds_source'])),PLAYGROUND_COLUMNS))
+
+
+# One combination, run in a worker. Returns the zip code table and the correlations in long form
+def run_job(task):
+    job,root,region,config=task
+    store=ArtifactStore(root)
+    artifacts={'income_tax_raw':store.load('income_{}'.format(job['year']),zero_copy=True),
+               'ny_zips_raw':store.load('zips_'+job['region'],zero_copy=True),
+               'parks_raw':store.load('parks_'+job['parks'],zero_copy=True),
+               'playgrounds_raw':store.load('playgrounds_'+job['parks'],zero_copy=True)}
+    config=dict(pipeline.DEFAULT_CONFIG,**config,counties=region['counties'],geojson=region['geojson'],slices=region['slices'])
+
+    with redirect_stdout(StringIO()):
+        for stage in (pipeline.playground_zip,pipeline.income_metrics,pipeline.correlation):
+            artifacts.update(stage(artifacts,config))
+
+    zips=artifacts['playground_income_table_clean']
+    zips=zips.set_axis(flatten_columns(zips.columns),axis=1)
+    correlations=[]
+    for name,filters in CORRELATIONS.items():
+        table=artifacts[name]
+        table=table.set_axis(flatten_columns(table.index),axis=0).rename_axis('metric')
+        long=table.stack().rename('r').reset_index().rename(columns={'level_1':'cell'})
+        long.insert(0,'filters',filters)
+        correlations.append(long)
+    correlations=pd.concat(correlations,ignore_index=True)
+    for frame in (zips,correlations):
+        for position,key in enumerate(['year','region','parks']):
+            frame.insert(position,key,job[key])
+    return zips,correlations
+
+
+def run_batch(jobs,root=BATCH_DIR,regions=REGIONS,parks=PARKS,income_source=None,config=None,workers=None,sources=None,verbose=True):
+    store=ArtifactStore(root)
+    start=time.perf_counter()
+    prepare_inputs(jobs,store,sources or data_sources.DataSources(),regions,parks,income_source,verbose)
+    prepared=time.perf_counter()
+
+    tasks=[(job,root,regions[job['region']],config or {}) for job in jobs]
+    workers=min(workers or os.cpu_count(),len(tasks))
+    if workers>1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results=list(pool.map(run_job,tasks))
+    else:
+        results=[run_job(task) for task in tasks]
+
+    zips=pd.concat([z for z,_ in results],ignore_index=True)
+    correlations=pd.concat([c for _,c in results],ignore_index=True)
+    store.save('longitudinal_zip_metrics',zips)
+    store.save('longitudinal_correlations',correlations)
+    if verbose:
+        print ('{} jobs on {} workers: inputs {:.2f}s, jobs {:.2f}s'.format(len(jobs),workers,prepared-start,time.perf_counter()-prepared))
+    return zips,correlations
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description='Runs the playground / income analysis for every year, region and parks source')
+    parser.add_argument('--years',nargs='+',type=int,default=[2016])
+    parser.add_argument('--regions',nargs='+',default=['nyc'],choices=list(REGIONS))
+    parser.add_argument('--parks',nargs='+',default=['nyc_dpr'],choices=list(PARKS))
+    parser.add_argument('--income-source',help='Income file path or url with {year}, default the IRS SOI file of the year')
+    parser.add_argument('--workers',type=int,help='Worker processes (default: one per core)')
+    parser.add_argument('--root',default=BATCH_DIR,help='Artifact store for the inputs and results')
+    parser.add_argument('--csv',help='Also write the longitudinal zip code table to this csv')
+    args=parser.parse_args(argv)
+
+    zips,correlations=run_batch(job_matrix(args.years,args.regions,args.parks),args.root,income_source=args.income_source,workers=args.workers)
+    if args.csv:
+        zips.to_csv(args.csv,index=False)
+    print (correlations[correlations['cell']==correlations['cell'].iloc[0]].pivot_table('r',['region','parks','filters','metric'],'year').head(20))
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,193 @@
+#### Benchmarks of the pipeline stages on synthetic data
+
+# Times the pipeline stages on data from synthetic_data.py at a given scale (nyc, state, national,
+# 10x) so a change to the playground or income logic shows up as a number:
+#
+#   playground_zip  - park zip codes + point in polygon lookup, ids and the zip code explode
+#   income_metrics  - bracket metrics (bracket_stats) and the agi range pivot
+#   correlation     - the four correl_table calls
+#   proximity       - KD-tree distances, counts and access scores of the zip code centroids
+#   maps            - border simplification, TopoJSON and the three folium maps (cold caches)
+#
+# Every stage runs `repeat` times and the median is compared with the stored baseline of the same
+# scale (benchmark_baseline.json). A stage slower than baseline * threshold is reported as a
+# regression and the exit status is 1. Baselines are machine dependent, refresh them with
+# --save-baseline after changing machines.
+#
+# --startup times fresh interpreters instead: 'import lodha' and a cold metrics only run
+# (lodha.compute of the correlations on nyc synthetic data). Both fail when they load one of the
+# DEFERRED libraries, those belong to the maps, charts and geocoding only. Their baseline is
+# stored under 'startup'.
+#
+# Usage: python benchmark.py [--scale nyc] [--stages ...] [--repeat 3] [--save-baseline]
+#        python benchmark.py --startup [--repeat 5] [--save-baseline]
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import map_geometry
+import pipeline
+import synthetic_data
+
+STAGES=['playground_zip','income_metrics','correlation','proximity','maps']
+BASELINE_PATH='benchmark_baseline.json'
+THRESHOLD=1.25
+MIN_DIFFERENCE=0.05         # Seconds, differences below this are noise whatever the ratio
+DEFERRED=['folium','matplotlib','pygeocoder','scipy']
+STARTUP={'import':'import lodha',
+         'cold_compute':'import lodha,tempfile\n'
+                        'with tempfile.TemporaryDirectory() as directory:\n'
+                        '    inputs,config=lodha.synthetic_inputs("nyc",directory)\n'
+                        '    lodha.compute(["correlation"],config,inputs)'}
+
+
+def _reset_map_caches(workdir):
+    map_geometry._loaded.clear()
+    map_geometry._simplified.clear()
+    map_geometry._topologies.clear()
+    shutil.rmtree(os.path.join(workdir,map_geometry.CACHE_DIR),ignore_errors=True)
+
+
+# Times the stages at one scale, returns {stage: {'median','min','runs'}}. Stages needed by the
+# requested ones run once untimed
+def run_benchmarks(scale='nyc',stages=STAGES,repeat=3,seed=0,verbose=True):
+    start=time.perf_counter()
+    data=synthetic_data.generate(scale,seed)
+    if verbose:
+        print ('generated {} data in {:.2f}s ({} playgrounds, {} parks, {} bracket rows)'.format(
+            scale,time.perf_counter()-start,len(data['playgrounds_raw']),len(data['parks_raw']),len(data['income_tax_raw'])))
+
+    results={}
+    cwd=os.getcwd()
+    workdir=tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        os.chdir(workdir)
+        config=dict(pipeline.DEFAULT_CONFIG,geojson=synthetic_data.write_geojson(data.pop('geojson'),os.path.join(workdir,'zips.geojson')),
+                    counties=data.pop('counties'),output_dir=workdir)
+        artifacts=dict(data)
+        for name in _plan(stages):
+            timed=name in stages
+            runs=[]
+            for _ in range(repeat if timed else 1):
+                if name=='maps':
+                    _reset_map_caches(workdir)
+                began=time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    outputs=pipeline.STAGES[name].func(artifacts,config)
+                runs.append(time.perf_counter()-began)
+            artifacts.update(outputs)
+            if timed:
+                results[name]={'median':statistics.median(runs),'min':min(runs),'runs':runs}
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir,ignore_errors=True)
+    return results
+
+
+# Times every STARTUP snippet in `repeat` fresh interpreters. 'deferred_loaded' lists the DEFERRED
+# libraries a snippet imported
+def run_startup(repeat=5,verbose=True):
+    here=os.path.dirname(os.path.abspath(__file__))
+    check='\nimport sys,json\nprint (json.dumps([m for m in {!r} if m in sys.modules]))'.format(DEFERRED)
+    results={}
+    for name,code in STARTUP.items():
+        runs=[]
+        for _ in range(repeat):
+            began=time.perf_counter()
+            done=subprocess.run([sys.executable,'-c',code+check],cwd=here,capture_output=True,text=True,check=True)
+            runs.append(time.perf_counter()-began)
+        results[name]={'median':statistics.median(runs),'min':min(runs),'runs':runs,
+                       'deferred_loaded':json.loads(done.stdout.strip().splitlines()[-1])}
+        if verbose and results[name]['deferred_loaded']:
+            print ('{} loaded {}'.format(name,', '.join(results[name]['deferred_loaded'])))
+    return results
+
+
+def _plan(targets):
+    return pipeline.plan(targets,skip=['ingest'])      # The synthetic tables replace the ingest outputs
+
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(results,scale,path=BASELINE_PATH):
+    baseline=load_baseline(path)
+    stages=baseline.get(scale,{}).get('stages',{})
+    stages.update({name:{'median':round(r['median'],4),'min':round(r['min'],4)} for name,r in results.items()})
+    baseline[scale]={'machine':platform.platform(),'python':platform.python_version(),'stages':stages}
+    with open(path,'w') as f:
+        json.dump(baseline,f,indent=1,sort_keys=True)
+
+
+# (stage, median, baseline median, ratio, status) for every timed stage. status is 'regression',
+# 'faster', 'ok' or 'new' (no baseline)
+def compare(results,baseline,threshold=THRESHOLD,min_difference=MIN_DIFFERENCE):
+    rows=[]
+    for name,result in results.items():
+        reference=baseline.get('stages',{}).get(name)
+        if reference is None:
+            rows.append((name,result['median'],None,None,'new'))
+            continue
+        ratio=result['median']/reference['median'] if reference['median'] else float('inf')
+        difference=result['median']-reference['median']
+        if ratio>threshold and difference>min_difference:
+            status='regression'
+        elif ratio<1/threshold and -difference>min_difference:
+            status='faster'
+        else:
+            status='ok'
+        rows.append((name,result['median'],reference['median'],ratio,status))
+    return rows
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description='Times the pipeline stages on synthetic data and compares them with a stored baseline')
+    parser.add_argument('--scale',default='nyc',choices=list(synthetic_data.SCALES))
+    parser.add_argument('--stages',nargs='*',default=STAGES,choices=STAGES)
+    parser.add_argument('--startup',action='store_true',help='Time the import and a cold metrics only run in fresh interpreters instead')
+    parser.add_argument('--repeat',type=int,default=3)
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--baseline',default=BASELINE_PATH)
+    parser.add_argument('--threshold',type=float,default=THRESHOLD,help='Slowdown ratio reported as a regression (default 1.25)')
+    parser.add_argument('--save-baseline',action='store_true',help='Store these timings as the baseline of the scale')
+    parser.add_argument('--json',help='Also write the timings to this file')
+    args=parser.parse_args(argv)
+
+    key='startup' if args.startup else args.scale
+    if args.startup:
+        results=run_startup(args.repeat)
+    else:
+        results=run_benchmarks(args.scale,args.stages,args.repeat,args.seed)
+    rows=compare(results,load_baseline(args.baseline).get(key,{}),args.threshold)
+    print ('{:<16}{:>10}{:>10}{:>8}  {}'.format('stage','median','baseline','ratio','status'))
+    for name,median,reference,ratio,status in rows:
+        print ('{:<16}{:>9.3f}s{:>10}{:>8}  {}'.format(name,median,
+            '' if reference is None else '{:.3f}s'.format(reference),'' if ratio is None else '{:.2f}'.format(ratio),status))
+
+    if args.json:
+        with open(args.json,'w') as f:
+            json.dump({'scale':key,'results':results},f,indent=1)
+    eager=any(result.get('deferred_loaded') for result in results.values())
+    if args.save_baseline and not eager:
+        save_baseline(results,key,args.baseline)
+        print ('baseline saved to '+args.baseline)
+        return 0
+    return 1 if eager or any(status=='regression' for *_,status in rows) else 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+#### Vectorized income bracket statistics
+
+# Computes the bracket level and zip code level income metrics of the income tax section
+# (weights, weighted averages, HoH metrics, mode and median bracket) for every zip code at
+# once. Rows are sorted by zip code and agi_stub a single time, every zip code then becomes a
+# contiguous segment and the per zip code aggregates are numpy segment reductions. The median
+# bracket is found with a per segment running sum instead of the rolling sum / merge chain.
+#
+# Assumes one row per (zip code, agi_stub) inside a group, which is how the IRS file is laid out.
+
+import numpy as np
+import pandas as pd
+
+GROUP_COLUMNS=['County Name','zipcode']     # Use ['STATE','zipcode'] for the nationwide file
+
+
+# Segment reductions over rows already sorted by group. `starts` holds the first row of every group.
+# Sums skip NaN like the pandas groupby sum did (brackets with no returns give NaN averages)
+def _segment_sum(values,starts):
+    return np.add.reduceat(np.where(np.isnan(values),0,values),starts)
+
+
+def _segment_max(values,starts):
+    return np.maximum.reduceat(values,starts)
+
+
+def bracket_metrics(income,group_columns=GROUP_COLUMNS):
+    group_columns=list(group_columns)
+    order=np.lexsort([income['agi_stub'].to_numpy()]+[pd.factorize(income[c],sort=True)[0] for c in reversed(group_columns)])
+    data=income.iloc[order].reset_index(drop=True)
+
+    codes=data.groupby(group_columns,sort=False).ngroup().to_numpy()
+    starts=np.flatnonzero(np.r_[True,codes[1:]!=codes[:-1]])
+    sizes=np.diff(np.r_[starts,len(data)])
+    group=np.repeat(np.arange(len(starts)),sizes)
+
+    n1=data['N1'].to_numpy(dtype=float)
+    mars4=data['MARS4'].to_numpy(dtype=float)
+    agi=data['A00100'].to_numpy(dtype=float)
+
+    # Zip code aggregates of the number of returns
+    n1_sum=_segment_sum(n1,starts)
+    n1_max=_segment_max(n1,starts)
+    n1_mean=n1_sum/sizes
+    with np.errstate(divide='ignore',invalid='ignore'):
+        n1_var=_segment_sum((n1-n1_mean[group])**2,starts)/(sizes-1)
+    n1_std=np.sqrt(n1_var)
+    mars4_sum=_segment_sum(mars4,starts)
+
+    # Bracket level metrics
+    with np.errstate(divide='ignore',invalid='ignore'):
+        hoh_total_agi=(mars4/n1)*agi
+        weight=n1/n1_sum[group]
+        hoh_weight=mars4/mars4_sum[group]
+        individual_agi=agi/n1
+    median_return=n1_sum/2
+    weighted_avg_agi=agi*weight
+    hoh_weighted_avg_agi=hoh_total_agi*hoh_weight
+
+    # Mode: the bracket(s) with the most returns
+    mode_individual_agi=np.where(n1==n1_max[group],individual_agi,np.nan)
+
+    # Median: the first bracket where the running number of returns passes half of the total
+    running=np.cumsum(n1)
+    running=running-np.repeat(running[starts]-n1[starts],sizes)
+    position=np.where(running>median_return[group],np.arange(len(data)),len(data))
+    median_position=np.minimum.reduceat(position,starts)
+    has_median=median_position<len(data)
+    median_range=np.full(len(starts),np.nan)
+    median_range[has_median]=data['agi_stub'].to_numpy()[median_position[has_median]]
+    median_individual_agi=np.where(data['agi_stub'].to_numpy()==median_range[group],individual_agi,np.nan)
+
+    # Same columns (and order) as the bracket level file the merge chain wrote, zip code aggregates included
+    brackets=data.copy()
+    brackets['hoh_total_agi']=hoh_total_agi
+    brackets[('N1','sum')]=n1_sum[group]
+    brackets[('N1','max')]=n1_max[group]
+    brackets[('N1','mean')]=n1_mean[group]
+    brackets[('N1','var')]=n1_var[group]
+    brackets[('N1','std')]=n1_std[group]
+    brackets[('MARS4','sum')]=mars4_sum[group]
+    brackets['weight']=weight
+    brackets['hoh_weight']=hoh_weight
+    brackets['median_return']=median_return[group]
+    brackets['weighted_avg_agi']=weighted_avg_agi
+    brackets['hoh_weighted_avg_agi']=hoh_weighted_avg_agi
+    brackets['individual_agi']=individual_agi
+    brackets['mode_individual_agi']=mode_individual_agi
+    brackets['median_range']=median_range[group]
+    brackets['median_individual_agi']=median_individual_agi
+    brackets=brackets.iloc[np.argsort(order)]        # Back to the input row order
+    brackets.index=income.index
+
+    # Zip code level table, same MultiIndex columns the groupby/agg chain in the script produced
+    keys=data.iloc[starts][group_columns].reset_index(drop=True)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        weighted_avg_agi_sum=_segment_sum(weighted_avg_agi,starts)
+        hoh_weighted_avg_agi_sum=_segment_sum(hoh_weighted_avg_agi,starts)
+        agi_sum=_segment_sum(agi,starts)
+        hoh_total_agi_sum=_segment_sum(hoh_total_agi,starts)
+        zips=pd.DataFrame({(c,''):keys[c] for c in group_columns})
+        zips[('N1','sum')]=n1_sum
+        zips[('N1','max')]=n1_max
+        zips[('N1','mean')]=n1_mean
+        zips[('N1','var')]=n1_var
+        zips[('N1','std')]=n1_std
+        zips[('MARS4','sum')]=mars4_sum
+        zips[('weighted_avg_agi','sum')]=weighted_avg_agi_sum
+        zips[('hoh_weighted_avg_agi','sum')]=hoh_weighted_avg_agi_sum
+        zips[('median_individual_agi','max')]=_segment_nanmax(median_individual_agi,starts)
+        zips[('mode_individual_agi','max')]=_segment_nanmax(mode_individual_agi,starts)
+        zips[('A00100','sum')]=agi_sum
+        zips[('A00100','mean')]=agi_sum/sizes
+        zips[('hoh_total_agi','sum')]=hoh_total_agi_sum
+        zips[('weighted_avg_capita','')]=weighted_avg_agi_sum/n1_sum
+        zips[('hoh_weighted_avg_capita','')]=hoh_weighted_avg_agi_sum/mars4_sum
+        zips[('simple_average','')]=agi_sum/n1_sum
+        zips[('hoh_simple_average','')]=mars4_sum/hoh_total_agi_sum     # Kept as MARS4/AGI to match the original metric
+    zips.columns=pd.MultiIndex.from_tuples(zips.columns)
+    if ('zipcode','') in zips:
+        zips[('zipcode','')]=zips[('zipcode','')].astype('str')
+
+    return brackets,zips
+
+
+# Max ignoring NaN (pandas groupby max semantics), NaN when the whole segment is NaN
+def _segment_nanmax(values,starts):
+    result=_segment_max(np.where(np.isnan(values),-np.inf,values),starts)
+    result[np.isneginf(result)]=np.nan
+    return result
@@ -0,0 +1,174 @@
+#### Headless chart rendering to files
+
+# The visualization sections of Lodha_Code.py draw the county scatter, one income line chart per
+# county, one boxplot per metric and the four playground / income scatters in for loops that end
+# in plt.show(), which blocks a batch run (and the boxplots all landed on the same axes). Here
+# every chart is a spec, a dict with the small flat frame it needs:
+#
+#   {'name':'income_by_zip_queens','kind':'line','data':frame,'x':'zipcode','y':[...],
+#    'title':...,'xlabel':...,'ylabel':...,'figsize':(10,5)}
+#
+#   kind  - 'line' (y columns against x), 'box' (one box per y column) or 'scatter' (y against x,
+#           one colour per value of the 'group' column)
+#
+# render_charts draws the specs in a process pool on the Agg canvas (no window, no pyplot state)
+# and writes every chart as PNG and/or SVG. Every figure gets its own canvas and is cleared once
+# saved, so memory does not grow with the number of charts. With one worker per chart the whole
+# set takes about as long as the slowest chart. The output files, the time of every chart and the
+# total time are written to a manifest (charts_manifest.json).
+#
+# Usage: render_charts(chart_specs(zip_income,playground_income_table_clean,counties),'charts')
+
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+CHART_DIR='charts'
+MANIFEST='charts_manifest.json'
+FORMATS=('png',)
+DPI=100
+INCOME_METRICS={('median_individual_agi','max'):'Median Individual AGI',
+                ('mode_individual_agi','max'):'Mode Individual AGI',
+                'weighted_avg_capita':'Weighted Average per Capita',
+                'simple_average':'Simple Average'}
+
+
+def _slug(text):
+    return re.sub(r'[^a-z0-9]+','_',text.lower()).strip('_')
+
+
+# Plain names also match the ('name','') columns of the zip code tables
+def _label(table,label):
+    if not isinstance(label,tuple) and (label,'') in table.columns:
+        return (label,'')
+    return label
+
+
+# Flat copy of the columns of a (two level) zip code table: {label: new name}
+def _frame(table,columns):
+    frame=table[[_label(table,label) for label in columns]]
+    frame.columns=list(columns.values())
+    return frame.reset_index(drop=True)
+
+
+# County scatter, income line charts (overall and per county) and one boxplot per income metric
+def income_chart_specs(zip_income,counties=()):
+    specs=[]
+
+    population=_frame(zip_income,{'County Name':'County Name',('N1','sum'):'Total Number of Returns',('N1','std'):'std'})
+    population['Normalized Standard Dev.']=(population['std']-population['std'].mean())/(population['std'].max()-population['std'].min())
+    specs.append({'name':'population_std','kind':'scatter','data':population,'group':'County Name',
+                  'x':'Total Number of Returns','y':'Normalized Standard Dev.',
+                  'title':'The St. Dev in an Area\'s AGI Compared to Household Count',
+                  'xlabel':'Total Number of Returns','ylabel':'Normalized Standard Dev. of Return Totals','figsize':(6.4,4.8)})
+
+    # x-axis in order of increasing standard deviation, the most homogenous zip codes on the left
+    zipcode_stats=_frame(zip_income,{'County Name':'County Name','zipcode':'zipcode',('N1','std'):'std',**INCOME_METRICS})
+    zipcode_stats=zipcode_stats.sort_values('std',kind='stable')
+    for county in [None]+list(counties):
+        county_df=zipcode_stats if county is None else zipcode_stats[zipcode_stats['County Name']==county]
+        specs.append({'name':'income_by_zip_'+_slug(county or 'overall'),'kind':'line','data':county_df.drop(columns=['County Name','std']),
+                      'x':'zipcode','y':list(INCOME_METRICS.values()),
+                      'title':'Overall' if county is None else 'Household Income by zip code for '+county,
+                      'xlabel':'Zipcode (in order of increasing standard deviation)','ylabel':'Individual Household AGI'})
+
+    for metric in INCOME_METRICS.values():
+        specs.append({'name':'boxplot_'+_slug(metric),'kind':'box','data':zipcode_stats[[metric]],'y':[metric],
+                      'title':metric,'figsize':(10,10)})
+    return specs
+
+
+# Playground count against total and weighted average HoH income, Manhattan and the other counties apart
+def playground_chart_specs(playground_income_table):
+    specs=[]
+    visual=_frame(playground_income_table,{'County Name':'County Name',('hoh_total_agi','sum'):'Total HoH Income',
+                                           'hoh_weighted_avg_capita':'Weighted Average AGI','playground_count':'playground_count'})
+    for column,ylabel,title in [('Total HoH Income','Total HoH Income in Zip Code','Household Income'),
+                                ('Weighted Average AGI','Weighted Average AGI per Family','Weighted Average Household Income')]:
+        for label,manhattan in [('Manhattan Only',True),('Excluding Manhattan',False)]:
+            subset=visual[(visual['County Name']=='New York')==manhattan]
+            specs.append({'name':'playgrounds_vs_'+_slug(column)+'_'+_slug(label),'kind':'scatter','data':subset,'group':'County Name',
+                          'x':'playground_count','y':column,
+                          'title':'Number of Playgrounds Available with Relation to {} ({})'.format(title,label),
+                          'xlabel':'Number of Available Playgrounds in Proximity','ylabel':ylabel})
+    return specs
+
+
+# Every chart of the visualization sections of Lodha_Code.py
+def chart_specs(zip_income,playground_income_table,counties=()):
+    return income_chart_specs(zip_income,counties)+playground_chart_specs(playground_income_table)
+
+
+def _line(ax,spec):
+    spec['data'].plot(kind='line',x=spec['x'],y=spec['y'],stacked=False,ax=ax)
+
+
+def _box(ax,spec):
+    spec['data'].boxplot(column=spec['y'],ax=ax)
+
+
+def _scatter(ax,spec):
+    data=spec['data']
+    for name,group in data.groupby(spec['group'],observed=True) if 'group' in spec else [(None,data)]:
+        ax.plot(group[spec['x']],group[spec['y']],marker='o',linestyle='',label=name)
+    if 'group' in spec and len(data):
+        ax.legend()
+
+
+KINDS={'line':_line,'box':_box,'scatter':_scatter}
+
+
+# Draws one spec and saves it in every format. Returns the manifest entry
+def render_chart(spec,output_dir=CHART_DIR,formats=FORMATS,dpi=DPI):
+    start=time.perf_counter()
+    figure=Figure(figsize=spec.get('figsize',(10,5)))
+    FigureCanvasAgg(figure)
+    try:
+        ax=figure.add_subplot()
+        KINDS[spec['kind']](ax,spec)
+        ax.set_title(spec.get('title',''))
+        if 'xlabel' in spec:
+            ax.set_xlabel(spec['xlabel'])
+        if 'ylabel' in spec:
+            ax.set_ylabel(spec['ylabel'])
+        files=[]
+        for fmt in formats:
+            path=os.path.join(output_dir,spec['name']+'.'+fmt)
+            figure.savefig(path,format=fmt,dpi=dpi)
+            files.append(path)
+    finally:
+        figure.clear()
+    return {'name':spec['name'],'kind':spec['kind'],'title':spec.get('title',''),'rows':len(spec['data']),
+            'files':files,'seconds':time.perf_counter()-start}
+
+
+def _render_task(task):
+    return render_chart(*task)
+
+
+# Renders every spec (in `workers` processes, default one per core and at most one per chart) and
+# writes the manifest. Returns the manifest
+def render_charts(specs,output_dir=CHART_DIR,formats=FORMATS,workers=None,dpi=DPI,manifest=MANIFEST):
+    os.makedirs(output_dir,exist_ok=True)
+    start=time.perf_counter()
+    tasks=[(spec,output_dir,tuple(formats),dpi) for spec in specs]
+    workers=max(1,min(workers or os.cpu_count(),len(tasks)))
+    if workers>1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            charts=list(pool.map(_render_task,tasks))
+    else:
+        charts=[_render_task(task) for task in tasks]
+
+    result={'charts':charts,'workers':workers,'seconds':time.perf_counter()-start,
+            'slowest_chart_seconds':max((chart['seconds'] for chart in charts),default=0.0)}
+    path=os.path.join(output_dir,manifest)
+    with open(path+'.tmp','w') as f:
+        json.dump(result,f,indent=1)
+    os.replace(path+'.tmp',path)
+    result['manifest']=path
+    return result
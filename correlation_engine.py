@@ -0,0 +1,171 @@
+#### Grouped target-vs-feature correlation
+
+# correl_table used to run DataFrame.corr on the whole table, on the table without Manhattan and
+# on every county, keeping one column of each full matrix. Only the correlation of every feature
+# with one target (playground_count) is needed, and Pearson's r only needs the sums of x, y, x^2,
+# y^2 and xy. Those sums are computed once per group (county) in a single sorted segment
+# reduction, and every slice that is a union of groups (all of NYC, NYC without Manhattan, ...)
+# is just a sum of group sums, so no slice re-reads the data.
+#
+# Missing values are handled pairwise like DataFrame.corr: a row only counts for a feature when
+# both the feature and the target are present.
+
+import numpy as np
+import pandas as pd
+
+
+# Resolves 'playground_count' to ('playground_count','') on tables with two level columns
+def _column(table,label):
+    if label in table.columns:
+        return label
+    if isinstance(table.columns,pd.MultiIndex) and (label,'') in table.columns:
+        return (label,'')
+    raise KeyError(label)
+
+
+# Per group sums (n, x, y, x^2, y^2, xy) for every feature, shape (6, groups, features).
+# y is the target column, or one target column per feature. Features are processed in blocks
+# so the temporaries stay small on wide tables. With return_shifts the per feature shifts of x and
+# y are returned too (see CorrelationSums)
+def _group_sums(x,y,codes,groups,block=64,return_shifts=False):
+    order=np.argsort(codes,kind='stable')
+    present,starts=np.unique(codes[order],return_index=True)
+    sums=np.zeros((6,groups,x.shape[1]))
+    shift_x=np.zeros(x.shape[1])
+    shift_y=np.zeros(x.shape[1])
+
+    for first in range(0,x.shape[1],block):
+        columns=np.arange(first,min(first+block,x.shape[1]))
+        # Features x rows layout (sorted by group), the segment reductions then run over contiguous memory
+        xb=x[np.ix_(order,columns)].T.copy()
+        yb=np.broadcast_to(y[order],xb.shape) if y.ndim==1 else y[np.ix_(order,columns)].T.copy()
+        valid=~np.isnan(xb)&~np.isnan(yb)
+        xb=np.where(valid,xb,0.0)
+        yb=np.where(valid,yb,0.0)
+        # Shifting by the column means keeps the sums small (better precision), r does not change
+        count=np.maximum(valid.sum(axis=1,keepdims=True),1)
+        shift_x[columns]=xb.sum(axis=1)/count[:,0]
+        shift_y[columns]=yb.sum(axis=1)/count[:,0]
+        xb=np.where(valid,xb-shift_x[columns,None],0.0)
+        yb=np.where(valid,yb-shift_y[columns,None],0.0)
+        for i,values in enumerate([valid.astype(float),xb,yb,xb*xb,yb*yb,xb*yb]):
+            sums[i,present[:,None],columns]=np.add.reduceat(values,starts,axis=1).T
+    if return_shifts:
+        return sums,shift_x,shift_y
+    return sums
+
+
+def _pearson(sums):
+    n,sx,sy,sxx,syy,sxy=sums
+    with np.errstate(divide='ignore',invalid='ignore'):
+        cov=n*sxy-sx*sy
+        var_x=n*sxx-sx**2
+        var_y=n*syy-sy**2
+        r=cov/np.sqrt(var_x*var_y)
+    # Constant columns only leave rounding noise in the variance
+    r[(n<2)|(var_x<=1e-9*n*sxx)|(var_y<=1e-9*n*syy)]=np.nan
+    return np.clip(r,-1,1)
+
+
+def _group_labels(table,group):
+    if group is None:
+        return np.zeros(len(table),dtype=int),[]
+    labels,names=pd.factorize(table[_column(table,group)])
+    names=list(names)
+    return np.where(labels<0,len(names),labels),names      # Rows without a group still count for the slices
+
+
+def _slice_columns(sums,names,slices,include_groups):
+    columns={}
+    for name,excluded in slices.items():
+        keep=[i for i,g in enumerate(names) if g not in excluded]+[len(names)]
+        columns[name]=_pearson(sums[:,keep].sum(axis=1,keepdims=True))[0]
+    if include_groups:
+        by_group=_pearson(sums)
+        for i,name in enumerate(names):
+            columns[name]=by_group[i]
+    return columns
+
+
+# The Pearson sums of grouped_correlation kept between runs, so rows can be added, removed or
+# changed without another pass over the table. Every feature keeps the shift it got when the sums
+# were built, so a row always adds (and later removes) exactly the same terms
+class CorrelationSums:
+
+    def __init__(self,sums,shift_x,shift_y,names,features):
+        self.sums=sums
+        self.shift_x=shift_x
+        self.shift_y=shift_y
+        self.names=list(names)
+        self.features=features
+
+    @classmethod
+    def from_table(cls,table,target,group=None):
+        target=_column(table,target)
+        numeric=table.select_dtypes('number')
+        labels,names=_group_labels(table,group)
+        sums,shift_x,shift_y=_group_sums(numeric.to_numpy(dtype=float),table[target].to_numpy(dtype=float),labels,len(names)+1,return_shifts=True)
+        return cls(sums,shift_x,shift_y,names,numeric.columns)
+
+    # Group position of every group value (len(names) for missing or unknown groups)
+    def labels(self,values):
+        positions={name:i for i,name in enumerate(self.names)}
+        return np.array([positions.get(value,len(self.names)) for value in values],dtype=int)
+
+    def _terms(self,x,y):
+        valid=~np.isnan(x)&~np.isnan(y)[:,None]
+        xs=np.where(valid,x-self.shift_x,0.0)
+        ys=np.where(valid,y[:,None]-self.shift_y,0.0)
+        return np.stack([valid.astype(float),xs,ys,xs*xs,ys*ys,xs*ys])
+
+    # Replaces rows (x_old, y_old) by (x_new, y_new). NaN rows count for nothing, so a NaN old row
+    # adds a row and a NaN new row removes it. x is rows x features, labels from labels()
+    def update(self,labels,x_old,y_old,x_new,y_new):
+        terms=self._terms(np.asarray(x_new,dtype=float),np.asarray(y_new,dtype=float))-self._terms(np.asarray(x_old,dtype=float),np.asarray(y_old,dtype=float))
+        np.add.at(self.sums,(slice(None),np.asarray(labels,dtype=int)),terms)
+
+    # Same frame as grouped_correlation(method='pearson')
+    def table(self,slices=None,include_groups=True):
+        return pd.DataFrame(_slice_columns(self.sums,self.names,dict(slices or {'all':[]}),include_groups),index=self.features)
+
+
+# Correlation of `target` with every numeric column of `table`.
+#   group  - column splitting the rows into groups (e.g. County Name), one output column per group
+#   slices - {name: [group values to exclude]} for extra columns built from the groups,
+#            e.g. {'All_NYC':[],'No_Manhattan':['New York']}
+#   method - 'pearson' or 'spearman'
+def grouped_correlation(table,target,group=None,slices=None,method='pearson',include_groups=True):
+    slices=dict(slices or {'all':[]})
+    if method=='pearson':
+        return CorrelationSums.from_table(table,target,group).table(slices,include_groups)
+
+    target=_column(table,target)
+    numeric=table.select_dtypes('number')
+    x=numeric.to_numpy(dtype=float)
+    y=table[target].to_numpy(dtype=float)
+    labels,names=_group_labels(table,group)
+
+    columns={}
+    if method=='spearman':
+        # Ranks depend on the rows in the slice, so every slice is ranked on its own. The groups
+        # are ranked together in one grouped rank call
+        for name,excluded in slices.items():
+            rows=~np.isin(labels,[i for i,g in enumerate(names) if g in excluded])
+            columns[name]=_spearman(x[rows],y[rows],np.zeros(rows.sum(),dtype=int),1)[0]
+        if include_groups:
+            by_group=_spearman(x,y,labels,len(names)+1)
+            for i,name in enumerate(names):
+                columns[name]=by_group[i]
+    else:
+        raise ValueError("method must be 'pearson' or 'spearman'")
+
+    return pd.DataFrame(columns,index=numeric.columns)
+
+
+# Pearson on ranks. Rows missing the feature or the target are dropped before ranking (pairwise),
+# every group is ranked separately
+def _spearman(x,y,codes,groups):
+    valid=~np.isnan(x)&~np.isnan(y)[:,None]
+    x_rank=pd.DataFrame(np.where(valid,x,np.nan)).groupby(codes).rank().to_numpy()
+    y_rank=pd.DataFrame(np.where(valid,y[:,None],np.nan)).groupby(codes).rank().to_numpy()
+    return _pearson(_group_sums(x_rank,y_rank,codes,groups))
@@ -0,0 +1,114 @@
+#### Bootstrap confidence intervals and permutation p-values for correl_table
+
+# The per county correlations are based on a few dozen zip codes, so a bare r says little. For
+# every (metric, group) cell this module adds a bootstrap percentile confidence interval and a
+# two sided permutation p-value.
+#
+# Resamples are done in batches with matrix products instead of one corr() per resample: a batch
+# of bootstrap samples is a (batch x rows) matrix of multinomial counts W, and the sums needed for
+# Pearson's r of every resample and every metric are W @ x, W @ x^2, ... A batch of permutations
+# is a (batch x rows) matrix of shuffled targets Y, the cross sums are Y @ x. Batches are spread
+# over a process pool. Every batch gets its own seed spawned from one SeedSequence, so the
+# results only depend on `seed` and not on the number of workers.
+
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from correlation_engine import _column, _pearson
+
+BATCH=250
+
+
+# One batch of resamples for one cell. x is (rows x metrics) with NaN for missing values and y
+# has no missing values, both centered. Returns (bootstrap r, permutation r), each (batch x metrics)
+def _resample_batch(task):
+    x,y,size,seed=task
+    rng=np.random.default_rng(seed)
+    rows=len(y)
+    v=(~np.isnan(x)).astype(float)
+    xv=np.nan_to_num(x)
+
+    # Bootstrap: multinomial counts per row, every sum becomes a weighted sum
+    w=rng.multinomial(rows,np.full(rows,1/rows),size=size).astype(float)
+    boot=_pearson(np.stack([w@v,w@xv,w@(v*y[:,None]),w@(xv**2),w@(v*(y**2)[:,None]),w@(xv*y[:,None])]))
+
+    # Permutation: shuffled copies of the target, the sums of the metric alone do not change
+    shuffled=rng.permuted(np.broadcast_to(y,(size,rows)),axis=1)
+    fixed=lambda values: np.broadcast_to(values,(size,len(values)))
+    perm=_pearson(np.stack([fixed(v.sum(axis=0)),fixed(xv.sum(axis=0)),shuffled@v,fixed((xv**2).sum(axis=0)),(shuffled**2)@v,shuffled@xv]))
+    return boot,perm
+
+
+# Row masks for every output column: the slices first, then one per group (same layout as correl_table)
+def _cells(table,group,slices):
+    if group is None:
+        return {name:np.ones(len(table),dtype=bool) for name in (slices or {'all':[]})}
+    values=table[_column(table,group)]
+    cells={name:~values.isin(excluded).to_numpy() for name,excluded in (slices or {}).items()}
+    for name in values.dropna().unique():
+        cells[name]=(values==name).to_numpy()
+    return cells
+
+
+# Observed r, bootstrap confidence interval and permutation p-value for the correlation of every
+# numeric column with `target`, for every slice and group. Returns a frame indexed by metric with
+# (cell, statistic) columns
+def resample_correlation(table,target,group=None,slices=None,resamples=10000,confidence=.95,seed=0,workers=None,batch=BATCH):
+    target=_column(table,target)
+    numeric=table.select_dtypes('number')
+    numeric=numeric.loc[:,[c!=target for c in numeric.columns]]
+    workers=workers or os.cpu_count()
+    cells=_cells(table,group,slices)
+
+    tasks=[]
+    inputs={}
+    seeds=iter(np.random.SeedSequence(seed).spawn(len(cells)*-(-resamples//batch)))
+    for name,rows in cells.items():
+        rows=rows&table[target].notna().to_numpy()
+        x=numeric.to_numpy(dtype=float)[rows]
+        y=table[target].to_numpy(dtype=float)[rows]
+        # Centering keeps the sums small, r does not change
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore',RuntimeWarning)
+            x=x-np.nanmean(x,axis=0)
+            y=y-y.mean()
+        inputs[name]=(x,y)
+        for start in range(0,resamples,batch):
+            seed_sequence=next(seeds)
+            if len(y)>=2:        # Nothing to resample in a cell with fewer than two zip codes
+                tasks.append((name,(x,y,min(batch,resamples-start),seed_sequence)))
+
+    if workers>1 and len(tasks)>1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results=list(pool.map(_resample_batch,[task for _,task in tasks]))
+    else:
+        results=[_resample_batch(task) for _,task in tasks]
+
+    alpha=(1-confidence)/2
+    columns={}
+    for name,(x,y) in inputs.items():
+        empty=[np.full((0,x.shape[1]),np.nan)]
+        boot=np.concatenate(empty+[b for (cell,_),(b,_) in zip(tasks,results) if cell==name])
+        perm=np.concatenate(empty+[p for (cell,_),(_,p) in zip(tasks,results) if cell==name])
+        v=(~np.isnan(x)).astype(float)
+        xv=np.nan_to_num(x)
+        observed=_pearson(np.stack([v.sum(axis=0),xv.sum(axis=0),v.T@y,(xv**2).sum(axis=0),v.T@(y**2),xv.T@y])[:,None])[0]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore',RuntimeWarning)
+            low,high=np.nanquantile(boot,[alpha,1-alpha],axis=0) if len(boot) else np.full((2,x.shape[1]),np.nan)
+        extreme=(np.abs(perm)>=np.abs(observed)-1e-12).sum(axis=0)
+        p_value=(1+extreme)/(1+np.isfinite(perm).sum(axis=0))
+        p_value[np.isnan(observed)]=np.nan
+        columns[(name,'r')]=observed
+        columns[(name,'ci_low')]=low
+        columns[(name,'ci_high')]=high
+        columns[(name,'p_value')]=p_value
+        columns[(name,'n')]=v.sum(axis=0)
+
+    result=pd.DataFrame(columns,index=numeric.columns)
+    result.columns=pd.MultiIndex.from_tuples(result.columns)
+    return result
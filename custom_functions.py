@@ -0,0 +1,44 @@
+#### Custom functions shared by Lodha_Code.py and the pipeline stages
+
+import pandas as pd
+
+from correlation_engine import grouped_correlation
+from map_geometry import GEOJSON_PATH, zip_topology
+
+# Calculates correlation between the given metrics of and the number of playgrounds 
+# in a given zip code. It calculates correlation in the whole city, all counties seperately, and the whole city not including manhattan
+# All columns come from one pass over the table (correlation_engine.py), more slices can be added with `slices`
+def correl_table(table,slices=None,method='pearson'):
+    slices=slices or {'All_NYC':[],'No_Manhattan':['New York']}
+    correlation_table=grouped_correlation(table,'playground_count',group='County Name',slices=slices,method=method)
+    
+    correlation_table['standard deviation']=correlation_table.std(axis=1)
+    
+    return correlation_table
+
+# This generates a heat map across NYC counties. It uses a geojson which contains 
+# the borders of the NYC counties. It then calculates the quantiles at every .2 interval of the dataset 
+# that needs to be visualized. It then generates the colors on top of the county borders. 
+# The colors are divided based on the quantiles. 
+# The borders come from map_geometry.py: loaded once, simplified for the zoom level and shared by every map as TopoJSON
+def generate_map(table,key_column,value_column,legend_name,detail='medium',geojson=GEOJSON_PATH):
+    import folium           # Only the maps need folium, the correlations import this module too
+
+    bins=list(table[value_column].quantile([0,.2,.4,.6,.8,.9,1]))    
+    # print (bins)
+
+    nyc_map=folium.Map(location=[40.7128,-74.0060],zoom_start=10)
+    folium.Choropleth(
+        geo_data=zip_topology(detail,geojson),
+        topojson='objects.zips',
+        fill_opacity=0.7,
+        line_opacity=0.2,
+        data=table,
+        key_on='feature.properties.postalCode',
+        columns=[key_column,value_column],
+        fill_color='YlOrRd',
+        legend_name=legend_name,
+        bins=bins
+    ).add_to(nyc_map)
+
+    return nyc_map
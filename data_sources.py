@@ -0,0 +1,181 @@
+#### Local snapshots of the downloaded data sources
+
+# Every run used to download the parks, playgrounds, IRS and NY zip code files again. Each source
+# is now fetched once into a local snapshot (artifacts/sources) together with its ETag,
+# Last-Modified and sha256. Later runs send a conditional request (If-None-Match /
+# If-Modified-Since) and only download the file again when the server says it changed, a 304
+# answer just reuses the snapshot. A snapshot whose checksum does not match (half written,
+# edited by hand) is not trusted and is downloaded again.
+#
+# When the server can not be reached the last snapshot is used, and without a snapshot the copy
+# in 'Original Data'. Only the parks and playgrounds copies ship with the repo, 16zpallagi.csv is
+# used when it is copied there by hand and the NY zip code file has no fallback. All requests go
+# through one requests.Session so the connections are pooled and reused.
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+SOURCE_DIR=os.path.join('artifacts','sources')
+SOURCES={
+    'parks':{'url':'https://www.nycgovparks.org/bigapps/DPR_Parks_001.json',
+             'fallback':'Original Data/DPR_Parks_001.json'},
+    'playgrounds':{'url':'https://www.nycgovparks.org/bigapps/DPR_Playgrounds_001.json',
+                   'fallback':'Original Data/DPR_Playgrounds_001.json'},
+    'income':{'url':'https://www.irs.gov/pub/irs-soi/16zpallagi.csv',
+              'fallback':'Original Data/16zpallagi.csv'},      # Not shipped (too large), only used when copied there
+    'ny_zips':{'url':'https://data.ny.gov/api/views/juva-r6g2/rows.csv?accessType=DOWNLOAD',
+               'fallback':None,
+               'filename':'ny_zip_codes.csv'},
+}
+BLOCK=1<<20
+
+
+def file_sha256(path):
+    digest=hashlib.sha256()
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(BLOCK),b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def is_url(source):
+    return urlparse(str(source)).scheme in ('http','https')
+
+
+# Session with a connection pool and retries on connection errors and 5xx answers
+def pooled_session(pool_size=4,retries=2,backoff=0.5):
+    session=requests.Session()
+    adapter=HTTPAdapter(pool_connections=pool_size,pool_maxsize=pool_size,
+                        max_retries=Retry(total=retries,backoff_factor=backoff,status_forcelist=[500,502,503,504],allowed_methods=['GET']))
+    session.mount('http://',adapter)
+    session.mount('https://',adapter)
+    return session
+
+
+class DataSources:
+
+    def __init__(self,root=SOURCE_DIR,sources=SOURCES,session=None,timeout=60,offline=False):
+        self.root=root
+        self.sources=sources
+        self.session=session or pooled_session()
+        self.timeout=timeout
+        self.offline=offline        # Never touch the network, snapshots and fallbacks only
+        self.counts={'downloaded':0,'not_modified':0,'snapshot':0,'fallback':0}
+        self.checksums={}           # sha256 of the snapshot every fetch returned (not set for local files and fallbacks)
+        self._lock=threading.Lock()
+        os.makedirs(root,exist_ok=True)
+
+    def _filename(self,name,url):
+        spec=self.sources.get(name,{})
+        return spec.get('filename') or os.path.basename(urlparse(url).path) or name
+
+    def snapshot_path(self,name,url=None):
+        url=url or self.sources[name]['url']
+        return os.path.join(self.root,name+'.'+self._filename(name,url))
+
+    def _meta_path(self,name):
+        return os.path.join(self.root,name+'.json')
+
+    # Snapshot metadata if the snapshot belongs to `url` and its checksum matches, else None
+    def snapshot(self,name,url=None):
+        url=url or self.sources[name]['url']
+        path=self.snapshot_path(name,url)
+        try:
+            with open(self._meta_path(name)) as f:
+                meta=json.load(f)
+        except (OSError,ValueError):
+            return None
+        if meta.get('url')!=url or not os.path.exists(path) or file_sha256(path)!=meta.get('sha256'):
+            return None
+        return meta
+
+    # Local path with the current content of the source. `url` overrides the registered url, a
+    # local path is returned as is
+    def fetch(self,name,url=None):
+        spec=self.sources.get(name,{})
+        url=url or spec['url']
+        if not is_url(url):
+            return url
+        path=self.snapshot_path(name,url)
+        meta=self.snapshot(name,url)
+
+        if self.offline:
+            return self._fallback(name,meta,path,None)
+
+        headers={}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match']=meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since']=meta['last_modified']
+        try:
+            with self.session.get(url,headers=headers,stream=True,timeout=self.timeout) as response:
+                if response.status_code==304 and meta is not None:
+                    self._count('not_modified')
+                    self.checksums[name]=meta['sha256']
+                    return path
+                response.raise_for_status()
+                meta=self._download(name,url,path,response)
+        except requests.RequestException as error:
+            return self._fallback(name,meta,path,error)
+        self._count('downloaded')
+        self.checksums[name]=meta['sha256']
+        return path
+
+    def _count(self,outcome):
+        with self._lock:
+            self.counts[outcome]+=1
+
+    def _download(self,name,url,path,response):
+        digest=hashlib.sha256()
+        size=0
+        tmp=path+'.tmp'
+        with open(tmp,'wb') as f:
+            for block in response.iter_content(BLOCK):
+                f.write(block)
+                digest.update(block)
+                size+=len(block)
+        os.replace(tmp,path)         # Readers never see a half written snapshot
+        meta={'url':url,'sha256':digest.hexdigest(),'size':size,'fetched':time.time(),
+              'etag':response.headers.get('ETag'),'last_modified':response.headers.get('Last-Modified')}
+        tmp=self._meta_path(name)+'.tmp'
+        with open(tmp,'w') as f:
+            json.dump(meta,f,indent=1)
+        os.replace(tmp,self._meta_path(name))
+        return meta
+
+    def _fallback(self,name,meta,path,error):
+        if meta is not None:
+            self._count('snapshot')
+            self.checksums[name]=meta['sha256']
+            return path
+        fallback=self.sources.get(name,{}).get('fallback')
+        if fallback and os.path.exists(fallback):
+            print ('Using '+fallback+' for '+name+(' ('+str(error)+')' if error else ''))
+            self._count('fallback')
+            return fallback
+        raise error or FileNotFoundError('No snapshot or fallback for '+name)
+
+    # Fetches several sources at once over the shared session, returns {name: path}
+    def fetch_all(self,names=None,urls=None,max_workers=4):
+        names=list(names or self.sources)
+        urls=urls or {}
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            paths=pool.map(lambda name: self.fetch(name,urls.get(name)),names)
+            return dict(zip(names,paths))
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,105 @@
+#### Persistent reverse geocode cache
+
+# Keeps every reverse geocode result in a local SQLite file keyed by the rounded lat/lon so the
+# nightly run only calls the external geocoder for points it has not seen before. Entries older
+# than the TTL are treated as misses and can be cleared with evict().
+#
+# Any object with a reverse_geocode(lat,lon) method returning something with a postal_code
+# attribute can be used as the geocoder (the pygeocoder Geocoder, a ConcurrentGeocoder or a
+# stub in tests).
+
+import sqlite3
+import time
+
+import numpy as np
+
+CACHE_PATH='geocode_cache.sqlite'
+DEFAULT_TTL=30*24*60*60     # 30 days
+
+
+class GeocodeCache:
+
+    def __init__(self,geocoder,path=CACHE_PATH,ttl=DEFAULT_TTL,precision=5,clock=time.time):
+        self.geocoder=geocoder
+        self.path=path
+        self.ttl=ttl
+        self.precision=precision          # Number of decimals kept in the key (5 decimals is about a meter)
+        self.clock=clock
+        self.hits=0
+        self.misses=0
+        self.connection=sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS geocode ('
+                                'lat INTEGER NOT NULL, lon INTEGER NOT NULL, '
+                                'postal_code TEXT, fetched_at REAL NOT NULL, '
+                                'PRIMARY KEY (lat,lon))')
+        self.connection.commit()
+
+    def _key(self,lat,lon):
+        scale=10**self.precision
+        return int(round(float(lat)*scale)),int(round(float(lon)*scale))
+
+    def get(self,lat,lon):
+        return self.get_many([lat],[lon])[0]
+
+    # Looks up every point in the cache and only calls the geocoder for the points that are
+    # missing or expired. Duplicate points in the batch are geocoded once.
+    def get_many(self,lats,lons):
+        keys=[self._key(lat,lon) for lat,lon in zip(lats,lons)]
+        cutoff=self.clock()-self.ttl
+
+        found={}
+        unique_keys=list(dict.fromkeys(keys))
+        for start in range(0,len(unique_keys),400):      # Stays under the SQLite bound parameter limit
+            chunk=unique_keys[start:start+400]
+            clause=' OR '.join(['(lat=? AND lon=?)']*len(chunk))
+            params=[value for key in chunk for value in key]
+            rows=self.connection.execute('SELECT lat,lon,postal_code FROM geocode WHERE fetched_at>=? AND ('+clause+')',
+                                         [cutoff]+params)
+            for lat,lon,postal_code in rows:
+                found[(lat,lon)]=postal_code
+
+        missing={}
+        for key,lat,lon in zip(keys,lats,lons):
+            if key in found or key in missing:
+                self.hits+=1
+            else:
+                self.misses+=1
+                missing[key]=(lat,lon)
+
+        # A geocoder with a batch method (ConcurrentGeocoder) gets all the misses in one call
+        if hasattr(self.geocoder,'reverse_geocode_many'):
+            results=self.geocoder.reverse_geocode_many([p[0] for p in missing.values()],[p[1] for p in missing.values()])
+        else:
+            results=[self.geocoder.reverse_geocode(lat,lon) for lat,lon in missing.values()]
+
+        fetched=[]
+        for key,result in zip(missing,results):
+            if result is None:               # Request failed, not cached so the next run tries again
+                found[key]=None
+                continue
+            found[key]=result.postal_code
+            fetched.append((key[0],key[1],result.postal_code,self.clock()))
+
+        if fetched:
+            self.connection.executemany('INSERT OR REPLACE INTO geocode VALUES (?,?,?,?)',fetched)
+            self.connection.commit()
+
+        return [found[key] for key in keys]
+
+    # Same contract as ZipLocator.lookup so the cache can be passed to resolve_zips
+    def lookup(self,lat,lon):
+        return np.array(self.get_many(list(lat),list(lon)),dtype=object)
+
+    # Removes all expired entries, returns how many were removed
+    def evict(self):
+        cursor=self.connection.execute('DELETE FROM geocode WHERE fetched_at<?',[self.clock()-self.ttl])
+        self.connection.commit()
+        return cursor.rowcount
+
+    def stats(self):
+        total=self.hits+self.misses
+        size=self.connection.execute('SELECT COUNT(*) FROM geocode').fetchone()[0]
+        return {'hits':self.hits,'misses':self.misses,'hit_rate':self.hits/total if total else 0.0,'size':size}
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,98 @@
+#### Concurrent reverse geocoding
+
+# Sends the reverse geocode requests for the playgrounds without a zip code through a bounded
+# thread pool. A token bucket keeps the request rate under the API quota, failed requests are
+# retried with exponential backoff and the latency of every request is recorded. Results come
+# back in the same order as the input points.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+# Classic token bucket: holds up to `burst` tokens and refills at `rate` tokens per second
+class TokenBucket:
+
+    def __init__(self,rate,burst=1,clock=time.monotonic,sleep=time.sleep):
+        self.rate=rate
+        self.burst=burst
+        self.tokens=burst
+        self.clock=clock
+        self.sleep=sleep
+        self.updated=clock()
+        self.lock=threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now=self.clock()
+                self.tokens=min(self.burst,self.tokens+(now-self.updated)*self.rate)
+                self.updated=now
+                if self.tokens>=1:
+                    self.tokens-=1
+                    return
+                wait=(1-self.tokens)/self.rate
+            self.sleep(wait)
+
+
+class ConcurrentGeocoder:
+
+    def __init__(self,geocoder,max_workers=8,rate=40,burst=None,retries=3,backoff=0.5,sleep=time.sleep):
+        self.geocoder=geocoder
+        self.max_workers=max_workers
+        self.bucket=TokenBucket(rate,burst or max_workers,sleep=sleep) if rate else None
+        self.retries=retries
+        self.backoff=backoff            # First retry waits backoff seconds, then 2x, 4x, ...
+        self.sleep=sleep
+        self.lock=threading.Lock()
+        self.latencies=[]
+        self.retry_count=0
+        self.errors=0
+
+    def _reverse_geocode(self,lat,lon):
+        for attempt in range(self.retries+1):
+            if self.bucket is not None:
+                self.bucket.acquire()
+            start=time.perf_counter()
+            try:
+                result=self.geocoder.reverse_geocode(lat,lon)
+            except Exception:
+                if attempt==self.retries:
+                    with self.lock:
+                        self.errors+=1
+                    return None
+                with self.lock:
+                    self.retry_count+=1
+                self.sleep(self.backoff*2**attempt)
+                continue
+            finally:
+                with self.lock:
+                    self.latencies.append(time.perf_counter()-start)
+            return result
+        return None
+
+    # Geocodes all points concurrently. Returns the geocoder results in input order,
+    # None for points that still failed after all retries
+    def reverse_geocode_many(self,lats,lons):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(self._reverse_geocode,lats,lons))
+
+    # Same contract as ZipLocator.lookup so the executor can be passed to resolve_zips
+    def lookup(self,lat,lon):
+        results=self.reverse_geocode_many(list(lat),list(lon))
+        return np.array([None if result is None else result.postal_code for result in results],dtype=object)
+
+    def stats(self):
+        with self.lock:
+            latencies=np.array(self.latencies)
+        if len(latencies)==0:
+            return {'requests':0,'retries':self.retry_count,'errors':self.errors}
+        return {'requests':len(latencies),
+                'retries':self.retry_count,
+                'errors':self.errors,
+                'latency_mean':latencies.mean(),
+                'latency_p50':np.percentile(latencies,50),
+                'latency_p95':np.percentile(latencies,95),
+                'latency_max':latencies.max()}
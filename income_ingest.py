@@ -0,0 +1,75 @@
+#### Streaming ingest of the IRS SOI zip code income file
+
+# The IRS zip code file (16zpallagi.csv) has ~150 columns for every zip code in the country but
+# only the financials columns of the NYC zip codes are used. The file is read in chunks with
+# only the needed columns parsed (usecols/dtype pushdown) and every chunk is filtered to a zip
+# code whitelist before it is kept, so memory depends on the rows kept and not on the file size.
+#
+# Works for a local path or a URL and for other SOI years. Older years use upper case column
+# names (ZIPCODE, AGI_STUB, ...), columns are matched case insensitively and renamed to the
+# names in `columns`.
+
+import sys
+import time
+
+import pandas as pd
+import psutil
+
+FINANCIALS=['zipcode','agi_stub','N1','mars1','MARS2','MARS4','A00100']
+DTYPES={'zipcode':'int32','agi_stub':'uint8'}
+CHUNKSIZE=100000
+
+
+# SOI file for a given tax year, e.g. soi_url(2016) -> .../16zpallagi.csv
+def soi_url(year):
+    return 'https://www.irs.gov/pub/irs-soi/{:02d}zpallagi.csv'.format(year%100)
+
+
+# Resident set size of the process in MB
+def rss_mb():
+    return psutil.Process().memory_info().rss/1024**2
+
+
+# Peak resident set size of the process in MB, the high water mark over the whole life of the
+# process (peak_wset on Windows, ru_maxrss elsewhere)
+def peak_rss_mb():
+    info=psutil.Process().memory_info()
+    if hasattr(info,'peak_wset'):
+        return info.peak_wset/1024**2
+    import resource
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1024**2 if sys.platform=='darwin' else peak/1024
+
+
+def read_income(source,zips=None,columns=FINANCIALS,chunksize=CHUNKSIZE,verbose=True):
+    wanted={c.lower():c for c in columns}
+    dtype={}
+    for name,kind in DTYPES.items():
+        dtype[name]=kind
+        dtype[name.upper()]=kind
+    zips=None if zips is None else pd.Index(pd.to_numeric(pd.Series(list(zips)),errors='coerce').dropna().astype('int64').unique())
+
+    start=time.perf_counter()
+    rss_start=rss_peak=rss_mb()
+    rows_read=0
+    kept=[]
+    reader=pd.read_csv(source,usecols=lambda c: c.lower() in wanted,dtype=dtype,chunksize=chunksize)
+    for chunk in reader:
+        rows_read+=len(chunk)
+        chunk=chunk.rename(columns=lambda c: wanted[c.lower()])
+        if zips is not None:
+            chunk=chunk[chunk['zipcode'].isin(zips)]
+        kept.append(chunk)
+        rss_peak=max(rss_peak,rss_mb())
+    income=pd.concat(kept,ignore_index=True)[list(columns)]
+    elapsed=time.perf_counter()-start
+    rss_peak=max(rss_peak,rss_mb())
+
+    stats={'rows_read':rows_read,
+           'rows_kept':len(income),
+           'seconds':elapsed,
+           'rows_per_second':rows_read/elapsed if elapsed else float('inf'),
+           'rss_growth_mb':rss_peak-rss_start}     # Largest resident set size seen after a chunk, minus the one before the read
+    if verbose:
+        print ("Read {rows_read:,} income rows ({rows_per_second:,.0f} rows/sec), kept {rows_kept:,}. Memory grew {rss_growth_mb:,.0f} MB".format(**stats))
+    return income,stats
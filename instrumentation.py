@@ -0,0 +1,210 @@
+#### Per section timing, memory and row count instrumentation
+
+# Wraps a section of the pipeline (data collection, playground cleanup, income cleanup,
+# correlations, maps) and records for it:
+#
+#   wall_seconds, cpu_seconds      - time.perf_counter / time.process_time
+#   peak_rss_mb, rss_growth_mb     - process high water mark after the section and how much the
+#                                    section raised it
+#   traced_peak_mb                 - peak Python allocations during the section (trace_memory=True,
+#                                    tracemalloc slows the code down so it is off by default)
+#   rows_in, rows_out, *_memory_mb - rows and deep memory footprint of the DataFrames going in and out
+#
+# Records are written as JSON or in the Prometheus text format (one gauge per metric with a stage
+# label). With profile='cprofile' (or 'pyinstrument' when it is installed) every section is also
+# profiled, the profile is written to profile_dir and the slowest functions are kept in the record.
+#
+#   metrics=Instrumentation()
+#   with metrics.section('playground_cleanup',inputs=playgrounds) as section:
+#       ...
+#       section.measure(outputs=playgrounds_by_zip)
+#   metrics.write('run_metrics.json')
+#
+# Code that can not be indented into a with block (the notebook cells of Lodha_Code.py) uses
+# section=metrics.start(name) ... section.stop(outputs=...) instead.
+
+import cProfile
+import functools
+import json
+import os
+import pstats
+import time
+import tracemalloc
+
+import pandas as pd
+
+from income_ingest import peak_rss_mb
+
+HOT_SPOTS=10
+METRICS=['wall_seconds','cpu_seconds','peak_rss_mb','rss_growth_mb','traced_peak_mb',
+         'rows_in','rows_out','input_memory_mb','output_memory_mb']
+HELP={'wall_seconds':'Wall clock time of the stage',
+      'cpu_seconds':'CPU time of the process during the stage',
+      'peak_rss_mb':'Peak resident set size of the process after the stage',
+      'rss_growth_mb':'Increase of the peak resident set size during the stage',
+      'traced_peak_mb':'Peak traced Python allocations during the stage',
+      'rows_in':'Rows of the input DataFrames',
+      'rows_out':'Rows of the output DataFrames',
+      'input_memory_mb':'Memory of the input DataFrames',
+      'output_memory_mb':'Memory of the output DataFrames'}
+
+
+# DataFrames inside a frame, a dict of frames or a list of frames (anything else is ignored)
+def _frames(value):
+    if isinstance(value,(pd.DataFrame,pd.Series)):
+        return [value]
+    if isinstance(value,dict):
+        value=list(value.values())
+    if isinstance(value,(list,tuple)):
+        return [frame for item in value for frame in _frames(item)]
+    return []
+
+
+def _footprint(value,deep=True):
+    frames=_frames(value)
+    memory=sum(int(frame.memory_usage(deep=deep).sum()) if isinstance(frame,pd.DataFrame) else int(frame.memory_usage(deep=deep)) for frame in frames)
+    return sum(len(frame) for frame in frames),memory/1024**2
+
+
+class Section:
+
+    def __init__(self,owner,name,inputs=None):
+        self.owner=owner
+        self.name=name
+        self.inputs=inputs
+        self.outputs=None
+        self.record=None
+
+    # Inputs and outputs can be given (or replaced) any time before the section stops
+    def measure(self,inputs=None,outputs=None):
+        if inputs is not None:
+            self.inputs=inputs
+        if outputs is not None:
+            self.outputs=outputs
+        return self
+
+    def start(self):
+        owner=self.owner
+        self._rss=peak_rss_mb()
+        if owner.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            self._traced=tracemalloc.get_traced_memory()[0]
+        self._profiler=None
+        if owner.profile=='cprofile':
+            self._profiler=cProfile.Profile()
+            self._profiler.enable()
+        elif owner.profile=='pyinstrument':
+            from pyinstrument import Profiler       # Optional, only needed for profile='pyinstrument'
+            self._profiler=Profiler()
+            self._profiler.start()
+        self._wall=time.perf_counter()
+        self._cpu=time.process_time()
+        return self
+
+    def stop(self,outputs=None,error=None):
+        wall=time.perf_counter()-self._wall
+        cpu=time.process_time()-self._cpu
+        owner=self.owner
+        if outputs is not None:
+            self.outputs=outputs
+        record={'stage':self.name,'wall_seconds':wall,'cpu_seconds':cpu}
+
+        if self._profiler is not None:
+            record.update(self._save_profile())
+        rss=peak_rss_mb()
+        record['peak_rss_mb']=rss
+        record['rss_growth_mb']=rss-self._rss
+        if owner.trace_memory:
+            record['traced_peak_mb']=(tracemalloc.get_traced_memory()[1]-self._traced)/1024**2
+        if self.inputs is not None:
+            record['rows_in'],record['input_memory_mb']=_footprint(self.inputs,owner.deep)
+        if self.outputs is not None:
+            record['rows_out'],record['output_memory_mb']=_footprint(self.outputs,owner.deep)
+        if error is not None:
+            record['error']=repr(error)
+
+        self.record=record
+        owner.records.append(record)
+        return record
+
+    def _save_profile(self):
+        owner=self.owner
+        os.makedirs(owner.profile_dir,exist_ok=True)
+        if owner.profile=='cprofile':
+            self._profiler.disable()
+            path=os.path.join(owner.profile_dir,self.name+'.prof')
+            self._profiler.dump_stats(path)
+            stats=pstats.Stats(self._profiler).stats
+            slowest=sorted(stats.items(),key=lambda item: item[1][3],reverse=True)[:owner.hot_spots]
+            return {'profile':path,
+                    'hot_spots':[{'function':'{}:{}({})'.format(*key),'calls':calls,'own_seconds':own,'cumulative_seconds':cumulative}
+                                 for key,(_,calls,own,cumulative,_) in slowest]}
+        self._profiler.stop()
+        path=os.path.join(owner.profile_dir,self.name+'.html')
+        with open(path,'w') as f:
+            f.write(self._profiler.output_html())
+        return {'profile':path}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self,kind,error,traceback):
+        self.stop(error=error)
+        return False
+
+
+class Instrumentation:
+
+    def __init__(self,trace_memory=False,profile=None,profile_dir='profiles',hot_spots=HOT_SPOTS,deep=True):
+        if profile not in (None,'cprofile','pyinstrument'):
+            raise ValueError("profile must be None, 'cprofile' or 'pyinstrument'")
+        self.trace_memory=trace_memory
+        self.profile=profile
+        self.profile_dir=profile_dir
+        self.hot_spots=hot_spots
+        self.deep=deep              # Deep memory_usage counts the strings of object columns (slower)
+        self.records=[]
+
+    # Context manager for one section
+    def section(self,name,inputs=None):
+        return Section(self,name,inputs)
+
+    # Section started now, stopped with .stop(outputs=...)
+    def start(self,name,inputs=None):
+        return Section(self,name,inputs).start()
+
+    # Decorator: DataFrame arguments are the inputs and the return value the outputs
+    def instrument(self,name=None):
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(*args,**kwargs):
+                with self.section(name or func.__name__,inputs=list(args)+list(kwargs.values())) as section:
+                    result=func(*args,**kwargs)
+                    section.measure(outputs=result)
+                return result
+            return wrapper
+        return decorate
+
+    def to_json(self):
+        return json.dumps({'sections':self.records},indent=1,default=str)
+
+    def to_prometheus(self,prefix='lodha_stage'):
+        lines=[]
+        for metric in METRICS:
+            samples=[(r['stage'],r[metric]) for r in self.records if metric in r]
+            if not samples:
+                continue
+            lines.append('# HELP {}_{} {}'.format(prefix,metric,HELP[metric]))
+            lines.append('# TYPE {}_{} gauge'.format(prefix,metric))
+            for stage,value in samples:
+                lines.append('{}_{}{{stage="{}"}} {}'.format(prefix,metric,stage.replace('\\','\\\\').replace('"','\\"'),float(value)))
+        return '\n'.join(lines)+'\n'
+
+    # .prom or .txt files get the Prometheus text format, anything else JSON
+    def write(self,path):
+        text=self.to_prometheus() if os.path.splitext(path)[1] in ('.prom','.txt') else self.to_json()
+        with open(path,'w') as f:
+            f.write(text)
+        return path
@@ -0,0 +1,95 @@
+#### Library entry point: the playground / income metrics without the visuals
+
+# Lodha_Code.py is the notebook export: importing it builds a Geocoder, downloads the data and
+# draws every chart and map, so none of it can be reused and even a metrics only run pays for
+# folium, matplotlib and pygeocoder. compute() runs the pipeline stages up to the targets and
+# returns their output frames:
+#
+#   import lodha
+#   results=lodha.compute()                                          # cached in artifacts/
+#   inputs,config=lodha.synthetic_inputs('nyc',directory)
+#   results=lodha.compute(['proximity'],config,inputs)                # in memory
+#
+# With `inputs` (the raw tables of the ingest stage) nothing is downloaded or cached, the stages
+# run in memory. Only the stages that draw (maps, charts) or need scipy (proximity) import those
+# libraries, when they run. 'python benchmark.py --startup' tracks the import time and the cold
+# start of a metrics only run.
+#
+# Usage: python lodha.py [target ...] [--synthetic nyc] [--output-dir results]
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+import pipeline
+import synthetic_data
+from artifact_store import ArtifactStore
+
+TARGETS=('correlation',)
+
+
+# Output frames of the target stages, {name: DataFrame}
+def compute(targets=TARGETS,config=None,inputs=None,root='artifacts',force=False,verbose=False):
+    targets=list(targets)
+    unknown=[t for t in targets if t not in pipeline.STAGES]
+    if unknown:
+        raise ValueError('unknown stage(s): '+', '.join(unknown))
+
+    with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+        if inputs is None:
+            runner=pipeline.Pipeline(config,ArtifactStore(root))
+            runner.run(targets,force=force,verbose=verbose)
+            return {name:runner.artifacts[name] for target in targets for name in runner.manifest[target]['frames']}
+
+        config=dict(pipeline.DEFAULT_CONFIG,**(config or {}))
+        artifacts=dict(inputs)
+        results={}
+        for name in pipeline.plan(targets,skip=['ingest']):
+            outputs=pipeline.STAGES[name].func(artifacts,config) or {}
+            artifacts.update(outputs)
+            if name in targets:
+                results.update({key:value for key,value in outputs.items() if isinstance(value,pd.DataFrame)})
+        return results
+
+
+# Synthetic inputs and the matching config (geojson written to `directory`)
+def synthetic_inputs(scale,directory,seed=0):
+    data=synthetic_data.generate(scale,seed)
+    config={'geojson':synthetic_data.write_geojson(data.pop('geojson'),os.path.join(directory,'zips.geojson')),
+            'counties':data.pop('counties')}
+    return data,config
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description='Computes the playground / income metrics (no maps or charts) and writes them as csv')
+    parser.add_argument('targets',nargs='*',default=list(TARGETS),help='Stages whose outputs are written (default: correlation)')
+    parser.add_argument('--synthetic',choices=list(synthetic_data.SCALES),help='Run on synthetic data of this size instead of the sources')
+    parser.add_argument('--output-dir',help='Write every output frame to <name>.csv here')
+    parser.add_argument('--artifacts',default='artifacts',help='Artifact store directory')
+    parser.add_argument('--force',action='store_true',help='Recompute the stages even when they are cached')
+    parser.add_argument('--quiet',action='store_true')
+    args=parser.parse_args(argv)
+
+    start=time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix='lodha_') as directory:
+        inputs,config=synthetic_inputs(args.synthetic,directory) if args.synthetic else (None,None)
+        results=compute(args.targets,config,inputs,args.artifacts,args.force,verbose=not args.quiet)
+    if args.output_dir:
+        os.makedirs(args.output_dir,exist_ok=True)
+        for name,frame in results.items():
+            frame.to_csv(os.path.join(args.output_dir,name+'.csv'))
+    if not args.quiet:
+        for name,frame in results.items():
+            print ('{:<48}{:>8} rows'.format(name,len(frame)))
+        print ('{:<48}{:>8.2f}s'.format('total',time.perf_counter()-start))
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+#### Simplified zip code geometry for the choropleth maps
+
+# generate_map used to read the 620 KB zip code geojson on every call and folium embedded the
+# full resolution borders into every html map. The geojson is now loaded once per process and
+# simplified at a few tolerances (in degrees, 0.0005 is about 50 m which is below a pixel at the
+# zoom level of the maps). Only postalCode is kept from the properties and coordinates are
+# rounded to 5 decimals.
+#
+# The simplification preserves topology: the rings are cut into arcs at every vertex where the
+# set of neighbouring zip codes changes, each arc is simplified once (Douglas-Peucker) and the
+# same simplified arc is used by both zip codes sharing it, so there are no gaps or overlaps
+# between neighbours. Simplified versions are also written next to the artifacts so the next
+# process only has to read the small file.
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+GEOJSON_PATH='Original Data/nyc_zip_code.geojson'
+CACHE_DIR=os.path.join('artifacts','geometry')
+TOLERANCES={'full':0.0,'high':0.0001,'medium':0.0005,'low':0.002}
+KEEP_PROPERTIES=['postalCode']
+PRECISION=5
+
+_loaded={}
+
+
+def load_geojson(path=GEOJSON_PATH):
+    info=os.stat(path)
+    key=(os.path.abspath(path),info.st_size,info.st_mtime_ns)
+    if key not in _loaded:
+        with open(path,'r') as jsonFile:
+            _loaded[key]=json.load(jsonFile)
+    return _loaded[key]
+
+
+# Douglas-Peucker on one polyline, returns the indexes of the points to keep
+def _douglas_peucker(points,tolerance):
+    keep=np.zeros(len(points),dtype=bool)
+    keep[0]=keep[-1]=True
+    stack=[(0,len(points)-1)]
+    while stack:
+        first,last=stack.pop()
+        if last-first<2:
+            continue
+        start,end=points[first],points[last]
+        segment=end-start
+        inner=points[first+1:last]
+        length=np.hypot(*segment)
+        if length==0:
+            distance=np.hypot(*(inner-start).T)
+        else:
+            distance=np.abs(segment[0]*(inner[:,1]-start[1])-segment[1]*(inner[:,0]-start[0]))/length
+        farthest=int(np.argmax(distance))
+        if distance[farthest]>tolerance:
+            split=first+1+farthest
+            keep[split]=True
+            stack.append((first,split))
+            stack.append((split,last))
+    return np.flatnonzero(keep)
+
+
+def _rings(geometry):
+    polygons=[geometry['coordinates']] if geometry['type']=='Polygon' else geometry['coordinates']
+    return [ring for polygon in polygons for ring in polygon]
+
+
+def _rebuild(geometry,rings):
+    rings=iter(rings)
+    if geometry['type']=='Polygon':
+        return {'type':'Polygon','coordinates':[next(rings) for _ in geometry['coordinates']]}
+    return {'type':'MultiPolygon','coordinates':[[next(rings) for _ in polygon] for polygon in geometry['coordinates']]}
+
+
+# Cuts a closed ring into arcs at its nodes, the vertices where the set of features using the
+# vertex changes. Yields (first,last,forward,canonical) per arc: first/last index into the ring
+# repeated twice, and the arc vertex keys in one canonical direction so a border shared by two
+# features gets the same key from both sides
+def _arcs(ring,keys,owners):
+    size=len(ring)-1
+    sets=[frozenset(owners[k]) for k in keys]
+    nodes=[i for i in range(size) if sets[i]!=sets[i-1 if i else size-1] or sets[i]!=sets[i+1]]
+    if len(nodes)<2:
+        # Island without shared borders: fix the start and the farthest vertex from it
+        far=int(np.argmax(np.hypot(*(ring[:-1]-ring[0]).T)))
+        nodes=sorted({0,far}) if far else [0]
+    nodes=nodes+[nodes[0]+size]
+
+    closed_keys=keys[:-1]+keys[:-1]
+    for first,last in zip(nodes[:-1],nodes[1:]):
+        arc_keys=closed_keys[first:last+1]
+        forward=arc_keys<=arc_keys[::-1]
+        yield first,last,forward,tuple(arc_keys if forward else arc_keys[::-1])
+
+
+def simplify_geojson(data,tolerance,precision=PRECISION,properties=KEEP_PROPERTIES):
+    features=data['features']
+    rings=[[np.asarray(ring,dtype=float)[:,:2] for ring in _rings(f['geometry'])] for f in features]
+
+    # Which features use every (rounded) vertex
+    owners={}
+    for index,feature_rings in enumerate(rings):
+        for ring in feature_rings:
+            for vertex in map(tuple,np.round(ring,7)):
+                owners.setdefault(vertex,set()).add(index)
+
+    arcs={}
+    simplified=[]
+    for feature_rings in rings:
+        new_rings=[]
+        for ring in feature_rings:
+            if tolerance<=0 or len(ring)<=4:
+                new_rings.append(ring)
+                continue
+            keys=[tuple(v) for v in np.round(ring,7)]
+            kept=[]
+            closed=np.concatenate([ring[:-1],ring[:-1]])
+            for first,last,forward,canonical in _arcs(ring,keys,owners):
+                arc=closed[first:last+1]
+                # Both neighbours look the arc up in the same direction so they simplify it identically
+                if canonical not in arcs:
+                    arcs[canonical]=_douglas_peucker(arc if forward else arc[::-1],tolerance)
+                index=arcs[canonical] if forward else (len(arc)-1-arcs[canonical])[::-1]
+                kept.extend(first+index[:-1])
+            kept=np.array(kept+[kept[0]])%(len(ring)-1)
+            new_ring=ring[kept]
+            new_rings.append(new_ring if len(new_ring)>=4 else ring)
+        simplified.append(new_rings)
+
+    out=[]
+    for feature,new_rings in zip(features,simplified):
+        coordinates=[np.round(ring,precision).tolist() for ring in new_rings]
+        out.append({'type':'Feature',
+                    'properties':{k:feature['properties'][k] for k in properties if k in feature['properties']},
+                    'geometry':_rebuild(feature['geometry'],coordinates)})
+    return {'type':'FeatureCollection','features':out}
+
+
+_simplified={}
+
+
+# Simplified geometry for one of the TOLERANCES levels (or a number), computed at most once per
+# process and kept on disk between runs
+def zip_geometry(level='medium',path=GEOJSON_PATH,cache_dir=CACHE_DIR):
+    tolerance=TOLERANCES.get(level,level)
+    info=os.stat(path)
+    key=(os.path.abspath(path),info.st_size,info.st_mtime_ns,tolerance)
+    if key in _simplified:
+        return _simplified[key]
+
+    digest=hashlib.sha256(repr(key[1:]).encode()+path.encode()).hexdigest()[:16]
+    cache_path=os.path.join(cache_dir,'{}.{}.geojson'.format(os.path.splitext(os.path.basename(path))[0],digest)) if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path,'r') as jsonFile:
+            geometry=json.load(jsonFile)
+    else:
+        geometry=simplify_geojson(load_geojson(path),tolerance)
+        if cache_path:
+            os.makedirs(cache_dir,exist_ok=True)
+            with open(cache_path+'.tmp','w') as jsonFile:
+                json.dump(geometry,jsonFile,separators=(',',':'))
+            os.replace(cache_path+'.tmp',cache_path)
+    _simplified[key]=geometry
+    return geometry
+
+
+# TopoJSON version of a (simplified) feature collection: every shared border is stored once as an
+# arc, coordinates are quantized to integers and delta encoded. Folium draws it with
+# Choropleth(topojson='objects.'+name)
+def to_topojson(geometry,name='zips',quantization=10000):
+    features=geometry['features']
+    feature_rings=[[np.asarray(ring,dtype=float) for ring in _rings(f['geometry'])] for f in features]
+    points=np.concatenate([ring for rings in feature_rings for ring in rings])
+    low=points.min(axis=0)
+    scale=(points.max(axis=0)-low)/(quantization-1)
+
+    quantized=[]
+    owners={}
+    for index,rings in enumerate(feature_rings):
+        new_rings=[]
+        for ring in rings:
+            ring=np.round((ring-low)/scale).astype(np.int64)
+            ring=ring[np.r_[True,(np.diff(ring,axis=0)!=0).any(axis=1)]]      # Points merged by the quantization
+            new_rings.append(ring)
+            for vertex in map(tuple,ring.tolist()):
+                owners.setdefault(vertex,set()).add(index)
+        quantized.append(new_rings)
+
+    arcs=[]
+    arc_index={}
+    geometries=[]
+    for feature,rings in zip(features,quantized):
+        ring_arcs=[]
+        for ring in rings:
+            keys=list(map(tuple,ring.tolist()))
+            references=[]
+            for first,last,forward,canonical in _arcs(ring,keys,owners):
+                if canonical not in arc_index:
+                    arc_index[canonical]=len(arcs)
+                    arc=np.array(canonical)
+                    arcs.append(np.vstack([arc[:1],np.diff(arc,axis=0)]).tolist())
+                references.append(arc_index[canonical] if forward else ~arc_index[canonical])
+            ring_arcs.append(references)
+        rebuilt=_rebuild(feature['geometry'],ring_arcs)
+        geometries.append({'type':rebuilt['type'],'arcs':rebuilt['coordinates'],'properties':feature['properties']})
+
+    return {'type':'Topology',
+            'transform':{'scale':scale.tolist(),'translate':low.tolist()},
+            'objects':{name:{'type':'GeometryCollection','geometries':geometries}},
+            'arcs':arcs}
+
+
+_topologies={}
+
+
+def zip_topology(level='medium',path=GEOJSON_PATH,cache_dir=CACHE_DIR):
+    geometry=zip_geometry(level,path,cache_dir)
+    if id(geometry) not in _topologies:
+        _topologies[id(geometry)]=(geometry,to_topojson(geometry))
+    return _topologies[id(geometry)][1]
@@ -0,0 +1,430 @@
+#### Incremental pipeline runner
+
+# Lodha_Code.py runs top to bottom, so changing a plot recomputes the downloads, the zip code
+# lookup, the income metrics and the correlations. Here the same work is split into named stages:
+#
+#   ingest -> playground_zip -> income_metrics -> correlation -> maps
+#                                                       |-> significance
+#                                                       \-> charts
+#                            \-> proximity (with income_metrics)
+#
+# Every stage gets a key from the hash of its code (the stage function plus the helper modules
+# it uses), its parameters (local input files are fingerprinted by size and modification time),
+# its version (ingest: the sha256 of every downloaded source, fetched with a conditional request
+# on every run) and the keys of the stages it depends on. The outputs are kept in the artifact store and a stage
+# whose key did not change is skipped; its outputs are only loaded when a downstream stage needs
+# to run.
+#
+# Usage: python pipeline.py [target ...] [--force] [--list] [--metrics run_metrics.json] [--profile cprofile]
+
+import argparse
+import contextlib
+import hashlib
+import importlib.util
+import inspect
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import bracket_stats
+import correlation_engine
+import correlation_resampling
+import custom_functions
+import data_sources
+import income_ingest
+import map_geometry
+import playground_normalize
+import schemas
+import zip_lookup
+from artifact_store import ArtifactStore
+from instrumentation import Instrumentation
+
+DEFAULT_CONFIG={
+    'parks_source':'https://www.nycgovparks.org/bigapps/DPR_Parks_001.json',
+    'playgrounds_source':'https://www.nycgovparks.org/bigapps/DPR_Playgrounds_001.json',
+    'income_source':'https://www.irs.gov/pub/irs-soi/16zpallagi.csv',
+    'ny_zips_source':'https://data.ny.gov/api/views/juva-r6g2/rows.csv?accessType=DOWNLOAD',
+    'geojson':'Original Data/nyc_zip_code.geojson',
+    'source_dir':data_sources.SOURCE_DIR,
+    'counties':['New York','Queens','Richmond','Kings','Bronx'],
+    'slices':{'All_NYC':[],'No_Manhattan':['New York']},        # Extra correlation columns: {name: [counties left out]}
+    'weighted_avg_capita_limit':1000000,
+    'compact_dtypes':False,         # Categoricals, Int32 counts and float32 ratios (schemas.py): about 1.7x less memory but slower stages
+    'resamples':10000,
+    'seed':0,
+    'output_dir':'.',
+    'chart_formats':['png'],        # png and/or svg, written to <output_dir>/charts
+    'chart_workers':None,           # Rendering processes, default one per core
+    'proximity':{'radii_km':[0.5,1.0],'k':3,'bandwidth_km':0.8,'samples_per_km2':None},      # See proximity.py
+}
+MANIFEST='pipeline_manifest.json'
+
+STAGES={}
+
+
+class Stage:
+
+    def __init__(self,name,func,deps,params,modules,files,version=None):
+        self.name=name
+        self.func=func
+        self.deps=list(deps)
+        self.params=list(params)        # Config keys the stage reads
+        self.modules=list(modules)      # Helper modules (or module names, not imported) whose source is part of the code version
+        self.files=list(files)          # Config keys of output files (anything not a DataFrame)
+        self.version=version            # Optional func(config) -> version of inputs outside the config (source checksums)
+
+    def code_version(self):
+        digest=hashlib.sha256(inspect.getsource(self.func).encode())
+        for module in self.modules:
+            if isinstance(module,str):
+                # The source file only, importing would load matplotlib / scipy just to hash it
+                with open(importlib.util.find_spec(module).origin,encoding='utf-8') as f:
+                    digest.update(f.read().encode())
+            else:
+                digest.update(inspect.getsource(module).encode())
+        return digest.hexdigest()
+
+
+def stage(name,deps=(),params=(),modules=(),files=(),version=None):
+    def register(func):
+        STAGES[name]=Stage(name,func,deps,params,modules,files,version)
+        return func
+    return register
+
+
+# Size and modification time for local files, the value itself for anything else (URLs, numbers)
+def _fingerprint(value):
+    if isinstance(value,str) and os.path.isfile(value):
+        info=os.stat(value)
+        return [value,info.st_size,info.st_mtime_ns]
+    return value
+
+
+# Stages needed for the targets, dependencies first. Stages in `skip` (and what only they need) are
+# left out, e.g. ingest when the raw tables are given
+def plan(targets,stages=STAGES,skip=()):
+    order=[]
+    def visit(name):
+        if name in order or name in skip:
+            return
+        for dep in stages[name].deps:
+            visit(dep)
+        order.append(name)
+    for target in targets:
+        visit(target)
+    return order
+
+
+# Stage outputs that have already been computed or are read from the artifact store on first use
+class Artifacts:
+
+    def __init__(self,store):
+        self.store=store
+        self.frames={}
+        self.used=[]            # Names read since the last reset, the inputs of the running stage
+
+    def __getitem__(self,name):
+        if name not in self.frames:
+            self.frames[name]=self.store.load(name)
+        if name not in self.used:
+            self.used.append(name)
+        return self.frames[name]
+
+    def __setitem__(self,name,frame):
+        self.frames[name]=frame
+
+
+class Pipeline:
+
+    def __init__(self,config=None,store=None,manifest=MANIFEST,stages=STAGES,instrumentation=None):
+        self.config=dict(DEFAULT_CONFIG,**(config or {}))
+        self.store=store or ArtifactStore()
+        self.manifest_path=os.path.join(self.store.root,manifest)
+        self.stages=stages
+        self.artifacts=Artifacts(self.store)
+        self.instrumentation=instrumentation      # Optional Instrumentation recording every stage that runs
+        self.manifest={}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest=json.load(f)
+
+    def plan(self,targets):
+        return plan(targets,self.stages)
+
+    # Version of the stage inputs outside the config, None for most stages. When it can not be
+    # checked (no network and no fallback) the version of the last run is used
+    def version(self,name):
+        stage=self.stages[name]
+        if not stage.version:
+            return None
+        try:
+            return stage.version(self.config)
+        except OSError as error:
+            if self.manifest.get(name,{}).get('version') is None:
+                raise
+            print ('Could not check the inputs of '+name+', using the last run ('+str(error)+')')
+            return self.manifest[name]['version']
+
+    # A stage with a version gets the content of its inputs from it, its params (the source paths
+    # and urls) are only hashed as names so touching a local file does not change the key
+    def key(self,name,keys,version=None):
+        stage=self.stages[name]
+        payload={'code':stage.code_version(),
+                 'params':{p:self.config[p] if stage.version else _fingerprint(self.config[p]) for p in stage.params},
+                 'deps':{dep:keys[dep] for dep in stage.deps}}
+        if stage.version:
+            payload['version']=version if version is not None else self.version(name)
+        return hashlib.sha256(json.dumps(payload,sort_keys=True,default=str).encode()).hexdigest()
+
+    def is_current(self,name,key):
+        entry=self.manifest.get(name)
+        if entry is None or entry['key']!=key:
+            return False
+        return all(self.store.exists(output) for output in entry['frames']) and all(os.path.exists(path) for path in entry['files'])
+
+    # versions overrides the version of some stages, e.g. {'ingest':version} when the sources were
+    # just fetched or the raw tables were saved by the caller
+    def run(self,targets,force=False,verbose=True,versions=None):
+        keys={}
+        report=[]
+        for name in self.plan(targets):
+            stage=self.stages[name]
+            version=versions[name] if versions and name in versions else self.version(name)
+            keys[name]=self.key(name,keys,version)
+            if not force and self.is_current(name,keys[name]):
+                report.append((name,'cached',0.0))
+                continue
+
+            start=time.perf_counter()
+            self.artifacts.used=[]
+            with self.instrumentation.section(name) if self.instrumentation else contextlib.nullcontext() as section:
+                outputs=stage.func(self.artifacts,self.config) or {}
+                if section is not None:
+                    section.measure(inputs=[self.artifacts.frames[used] for used in self.artifacts.used],outputs=outputs)
+            frames=[]
+            for output,frame in outputs.items():
+                if isinstance(frame,pd.DataFrame):
+                    self.store.save(output,frame)
+                    self.artifacts[output]=frame
+                    frames.append(output)
+            elapsed=time.perf_counter()-start
+
+            self.manifest[name]={'key':keys[name],'deps':{dep:keys[dep] for dep in stage.deps},'version':version,'frames':frames,
+                                 'files':[self.config[f] if f in self.config else outputs[f] for f in stage.files],
+                                 'seconds':elapsed}
+            self._write_manifest()
+            report.append((name,'ran',elapsed))
+
+        if verbose:
+            for name,status,elapsed in report:
+                print ('{:<16}{:<8}{:>9.2f}s'.format(name,status,elapsed))
+        return report
+
+    def _write_manifest(self):
+        tmp=self.manifest_path+'.tmp'
+        with open(tmp,'w') as f:
+            json.dump(self.manifest,f,indent=1)
+        os.replace(tmp,self.manifest_path)
+
+
+# Single level frame -> two level columns so it can be merged with the MultiIndex zip tables
+def _two_level(frame):
+    frame=frame.copy()
+    frame.columns=pd.MultiIndex.from_tuples([(c,'') for c in frame.columns])
+    return frame
+
+
+#### Stages
+
+SOURCES=['parks','playgrounds','income','ny_zips']
+_fetched={}         # Paths of the last fetch_sources per source config, read by the ingest stage that follows
+
+
+def _source_config(config):
+    return json.dumps([config['source_dir']]+[config[name+'_source'] for name in SOURCES])
+
+
+# Conditional fetch of every source (a download only when the server copy changed). Returns the
+# local paths and the version of every source: the sha256 of the snapshot, or the size and
+# modification time of a local file or fallback copy
+def fetch_sources(config):
+    sources=data_sources.DataSources(config['source_dir'])
+    try:
+        paths=sources.fetch_all(SOURCES,urls={name:config[name+'_source'] for name in SOURCES})
+    finally:
+        sources.close()
+    _fetched[_source_config(config)]=paths
+    return paths,{name:sources.checksums.get(name) or _fingerprint(paths[name]) for name in SOURCES}
+
+
+def source_versions(config):
+    return fetch_sources(config)[1]
+
+
+@stage('ingest',params=['parks_source','playgrounds_source','income_source','ny_zips_source'],modules=[income_ingest,data_sources],version=source_versions)
+def ingest(artifacts,config):
+    paths=_fetched.pop(_source_config(config),None) or fetch_sources(config)[0]
+    ny_zips_raw=pd.read_csv(paths['ny_zips'])
+    income_tax_raw,_=income_ingest.read_income(paths['income'],zips=ny_zips_raw['ZIP Code'])
+    return {'parks_raw':pd.read_json(paths['parks']),
+            'playgrounds_raw':pd.read_json(paths['playgrounds']),
+            'ny_zips_raw':ny_zips_raw,
+            'income_tax_raw':income_tax_raw}
+
+
+@stage('playground_zip',deps=['ingest'],params=['geojson','compact_dtypes'],modules=[zip_lookup,playground_normalize,schemas])
+def playground_zip(artifacts,config):
+    playgrounds,unplaced=playground_normalize.located_playgrounds(artifacts['playgrounds_raw'],artifacts['parks_raw'])
+    total_playgrounds=len(playgrounds)+len(unplaced)
+    number_of_nulls=unplaced['Playground_ID'].count()
+    print ("The Zip code for "+str(number_of_nulls)+" ("+"{0:.0%}".format(number_of_nulls/total_playgrounds)+") could not be determined and is being dropped")
+
+    playgrounds['zip_clean']=zip_lookup.resolve_zips(playgrounds,zip_lookup.ZipLocator.from_geojson(config['geojson']))
+    playgrounds,playgrounds_by_zip=playground_normalize.normalize_playgrounds(playgrounds)
+    if config['compact_dtypes']:
+        playgrounds=schemas.apply_schema(playgrounds,schemas.PLAYGROUNDS)
+        playgrounds_by_zip=schemas.apply_schema(playgrounds_by_zip,schemas.PLAYGROUNDS_BY_ZIP)
+    return {'playgrounds':playgrounds,'playgrounds_by_zip':playgrounds_by_zip}
+
+
+@stage('income_metrics',deps=['ingest'],params=['counties','compact_dtypes'],modules=[bracket_stats,schemas])
+def income_metrics(artifacts,config):
+    ny_zips=artifacts['ny_zips_raw'][['County Name','ZIP Code']]
+    nyc_zips=ny_zips[ny_zips['County Name'].str.contains('|'.join(config['counties']))]
+
+    income_tax_raw=artifacts['income_tax_raw']
+    if config['compact_dtypes']:
+        income_tax_raw=schemas.apply_schema(income_tax_raw,schemas.INCOME)
+    nyc_income=income_tax_raw.merge(nyc_zips,left_on='zipcode',right_on='ZIP Code',how='inner')
+    nyc_income['calc_total_returns']=nyc_income['mars1']+nyc_income['MARS2']+nyc_income['MARS4']
+    nyc_income['num_of_returns_error']=np.abs(nyc_income['N1']-nyc_income['calc_total_returns'])/nyc_income['N1']
+    nyc_income,zip_income=bracket_stats.bracket_metrics(nyc_income)
+
+    agi_range=nyc_income[['County Name','zipcode','agi_stub','N1','MARS4']]
+    agi_range_pivot=agi_range.pivot_table(['N1','MARS4'],['County Name','zipcode'],'agi_stub').reset_index()
+    agi_range_pivot[('N1','sum')]=agi_range_pivot['N1'].sum(axis=1)
+    agi_range_pivot[('MARS4','sum')]=agi_range_pivot['MARS4'].sum(axis=1)
+    agi_range_pivot[('zipcode','')]=agi_range_pivot[('zipcode','')].astype(str)
+    if config['compact_dtypes']:
+        nyc_income=schemas.apply_schema(nyc_income,schemas.BRACKETS)
+        zip_income=schemas.apply_schema(zip_income,schemas.ZIPS)
+        agi_range_pivot=schemas.apply_schema(agi_range_pivot,schemas.AGI_RANGE)
+    return {'nyc_bracket_level':nyc_income,'zip_income':zip_income,'agi_range_pivot':agi_range_pivot}
+
+
+# Correlation tables of the correlation stage: name -> (base table, playground count). The delta
+# refresh (playground_delta.py) updates the same tables
+CORRELATIONS={'income_playground_correl_no_filters':('zip_income','playground_count'),
+              'correl_between_bracket_and_playgrounds':('agi_range_pivot','playground_count'),
+              'outliers_excluding_correlation':('zip_income_clean','playground_count_clean'),
+              'agi_range_outliers_excluding_correlation':('agi_range_pivot','playground_count_clean')}
+
+
+def correlation_bases(artifacts,config):
+    zip_income=artifacts['zip_income']
+    return {'zip_income':zip_income,
+            'zip_income_clean':zip_income[zip_income[('weighted_avg_capita','')]<=config['weighted_avg_capita_limit']],
+            'agi_range_pivot':artifacts['agi_range_pivot']}
+
+
+def playground_counts(playgrounds_by_zip):
+    def count(by_zip):
+        return by_zip[['Zip','id_clean']].groupby('Zip').count().reset_index().rename(columns={'id_clean':'playground_count'})
+    return {'playground_count':count(playgrounds_by_zip),
+            'playground_count_clean':count(playgrounds_by_zip[playgrounds_by_zip['zip_code_count']<3])}
+
+
+def with_count(table,count):
+    return table.merge(_two_level(count),left_on=[('zipcode','')],right_on=[('Zip','')],how='left')
+
+
+@stage('correlation',deps=['playground_zip','income_metrics'],params=['weighted_avg_capita_limit','slices'],modules=[custom_functions,correlation_engine])
+def correlation(artifacts,config):
+    counts=playground_counts(artifacts['playgrounds_by_zip'])
+    bases=correlation_bases(artifacts,config)
+    outputs=dict(counts,playground_income_table_clean=with_count(bases['zip_income_clean'],counts['playground_count_clean']))
+    for name,(base,count) in CORRELATIONS.items():
+        outputs[name]=custom_functions.correl_table(with_count(bases[base],counts[count]),config['slices'])
+    return outputs
+
+
+@stage('significance',deps=['correlation'],params=['resamples','seed','slices'],modules=[correlation_engine,correlation_resampling])
+def significance(artifacts,config):
+    table=artifacts['playground_income_table_clean']
+    return {'outliers_excluding_correlation_significance':correlation_resampling.resample_correlation(
+        table,'playground_count',group='County Name',slices=config['slices'],
+        resamples=config['resamples'],seed=config['seed'])}
+
+
+@stage('proximity',deps=['playground_zip','income_metrics'],params=['geojson','proximity','slices'],modules=['proximity',correlation_engine])
+def proximity_metrics(artifacts,config):
+    import proximity        # scipy, only loaded when the stage runs
+    zip_proximity=proximity.zip_proximity(artifacts['playgrounds'],config['geojson'],**config['proximity'])
+    table=artifacts['zip_income'].merge(_two_level(zip_proximity),left_on=[('zipcode','')],right_on=[('Zip','')],how='left')
+    return {'zip_proximity':zip_proximity,
+            'access_score_correlation':correlation_engine.grouped_correlation(table,'access_score',group='County Name',slices=config['slices'])}
+
+
+@stage('maps',deps=['income_metrics','correlation'],params=['output_dir','geojson'],modules=[custom_functions,map_geometry],files=['weighted_average_map','total_income_map','playground_map'])
+def maps(artifacts,config):
+    zip_income=artifacts['zip_income']
+    outputs={'weighted_average_map':os.path.join(config['output_dir'],'weighted_average_income_map.html'),
+             'total_income_map':os.path.join(config['output_dir'],'total_family_income_map.html'),
+             'playground_map':os.path.join(config['output_dir'],'playground_distribution_map.html')}
+    custom_functions.generate_map(zip_income,('zipcode',''),('hoh_weighted_avg_capita',''),'Weighted Average Income per Family',geojson=config['geojson']).save(outputs['weighted_average_map'])
+    custom_functions.generate_map(zip_income,('zipcode',''),('hoh_total_agi','sum'),'Total Income from Families Distribution',geojson=config['geojson']).save(outputs['total_income_map'])
+    custom_functions.generate_map(artifacts['playground_count_clean'],'Zip','playground_count','Total Park Count In County',geojson=config['geojson']).save(outputs['playground_map'])
+    return outputs
+
+
+@stage('charts',deps=['income_metrics','correlation'],params=['output_dir','counties','chart_formats'],modules=['charts'],files=['chart_manifest'])
+def render_charts(artifacts,config):
+    import charts           # matplotlib, only loaded when the stage runs
+    specs=charts.chart_specs(artifacts['zip_income'],artifacts['playground_income_table_clean'],config['counties'])
+    rendered=charts.render_charts(specs,os.path.join(config['output_dir'],charts.CHART_DIR),config['chart_formats'],config['chart_workers'])
+    print ('{} charts on {} workers in {:.2f}s (slowest chart {:.2f}s)'.format(len(rendered['charts']),rendered['workers'],rendered['seconds'],rendered['slowest_chart_seconds']))
+    return {'chart_manifest':rendered['manifest']}
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description='Runs the playground / income pipeline, skipping stages that are up to date')
+    parser.add_argument('targets',nargs='*',default=list(STAGES),help='Stages to build (default: every stage)')
+    parser.add_argument('--force',action='store_true',help='Re-run every stage needed for the targets')
+    parser.add_argument('--list',action='store_true',help='List the stages and exit')
+    parser.add_argument('--artifacts',default='artifacts',help='Artifact store directory')
+    parser.add_argument('--config',help='JSON file overriding DEFAULT_CONFIG (e.g. local copies of the sources)')
+    parser.add_argument('--metrics',help='Write time, memory and row counts of the stages that ran to this file (.json, or .prom for Prometheus)')
+    parser.add_argument('--trace-memory',action='store_true',help='Also record peak Python allocations per stage (tracemalloc, slower)')
+    parser.add_argument('--profile',choices=['cprofile','pyinstrument'],help='Profile every stage that runs, profiles go to the profiles directory')
+    args=parser.parse_args(argv)
+
+    if args.list:
+        for name,s in STAGES.items():
+            print (name+('  <- '+', '.join(s.deps) if s.deps else ''))
+        return 0
+
+    config=None
+    if args.config:
+        with open(args.config) as f:
+            config=json.load(f)
+    unknown=[t for t in args.targets if t not in STAGES]
+    if unknown:
+        parser.error('unknown stage(s): '+', '.join(unknown))
+
+    start=time.perf_counter()
+    instrumentation=None
+    if args.metrics or args.trace_memory or args.profile:
+        instrumentation=Instrumentation(trace_memory=args.trace_memory,profile=args.profile)
+    Pipeline(config,ArtifactStore(args.artifacts),instrumentation=instrumentation).run(args.targets,force=args.force)
+    if args.metrics:
+        instrumentation.write(args.metrics)
+    print ('{:<16}{:<8}{:>9.2f}s'.format('total','',time.perf_counter()-start))
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,326 @@
+#### Delta refresh of the playground counts and correlations
+
+# Between two downloads of DPR_Playgrounds_001.json only a handful of records change, but a
+# pipeline run resolves every zip code again, explodes every playground and recomputes every
+# playground count and correlation table. refresh() works from the outputs of the last run:
+#
+#   0. the feeds are fetched with a conditional request (pipeline.fetch_sources); when their
+#      sha256 is the one of the last run nothing else is read
+#   1. the new feed (after the park Zip merge) is diffed against the playgrounds of the last run
+#      by KEY (Prop_ID / Playground_ID / School_ID) and a hash of every column: added, removed
+#      and changed rows
+#   2. zip codes are resolved for the added rows and the changed rows whose lat / lon / Zip
+#      changed (the others keep theirs) and only those rows are normalized
+#   3. playgrounds_by_zip and the playground counts are updated for the zip codes those rows touch
+#   4. the Pearson sums of the four correlation tables (correlation_engine.CorrelationSums, kept
+#      next to the artifacts) are updated for the zip codes whose count changed
+#
+# Hashing the feed is the only pass over all the rows (vectorized), the zip code lookup, the
+# normalization and the correlation updates scale with the size of the diff. The results are saved
+# under the names of the playground_zip and correlation stage outputs and the pipeline manifest
+# gets the keys of the new feed versions, so a pipeline run does not redo them; the stages after
+# them (significance, proximity, maps, charts) are marked to run again. Without a previous run,
+# when the code or the config changed since or when the IRS / NY zip code sources changed too,
+# refresh() runs the pipeline instead, for the versions it already fetched.
+#
+# Usage: python playground_delta.py [--artifacts artifacts] [--config config.json]
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import pipeline
+import playground_normalize
+import schemas
+import zip_lookup
+from artifact_store import ArtifactStore
+from correlation_engine import CorrelationSums
+from playground_normalize import KEY
+
+LOCATION=['lat','lon','Zip']
+TRIPLE=['id_clean','zip_code_count','Zip']
+UPDATED=['ingest','playground_zip','income_metrics','correlation']      # income_metrics only reads the unchanged income sources
+FEEDS=['parks','playgrounds']
+STATE='playground_delta.json'
+SUMS='playground_delta_sums.npz'
+
+
+# One uint64 per row. Numbers are hashed as float64 and everything else as text, so the same record
+# hashes the same whether it comes from the raw json or from a stored (compact dtype) artifact
+def hash_rows(frame,columns):
+    values={}
+    for column in columns:
+        series=frame[column]
+        if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            values[column]=series.to_numpy(dtype=float,na_value=np.nan)
+        else:
+            values[column]=series.astype(object).where(series.notna(),None).astype(str).to_numpy()
+    return pd.util.hash_pandas_object(pd.DataFrame(values),index=False).to_numpy()
+
+
+# Positions of the rows of `current` that were added or changed since `previous`, and of the rows
+# of `previous` that were removed or changed. `moved` marks the changed rows (of current) whose
+# location changed, `position` is the row of previous with the same KEY (-1 when added)
+def diff_playgrounds(previous,current,columns):
+    position=pd.Index(hash_rows(previous,KEY)).get_indexer(hash_rows(current,KEY))
+    matched=position>=0
+    same=np.zeros(len(current),dtype=bool)
+    same[matched]=hash_rows(previous,columns)[position[matched]]==hash_rows(current,columns)[matched]
+    moved=~matched
+    moved[matched]=hash_rows(previous,LOCATION)[position[matched]]!=hash_rows(current,LOCATION)[matched]
+    kept=np.zeros(len(previous),dtype=bool)
+    kept[position[same]]=True
+    changed=np.flatnonzero(~same)
+    return {'changed':changed,'stale':np.flatnonzero(~kept),'same':np.flatnonzero(same),
+            'moved':moved[changed],'position':position}
+
+
+# Version of a feed given as a frame instead of a downloaded snapshot
+def _frame_version(frame):
+    return 'rows:{:016x}'.format(int(hash_rows(frame,list(frame.columns)).sum(dtype=np.uint64)))
+
+
+def _triples(frame):
+    triples=frame[TRIPLE].copy()
+    triples['zip_code_count']=triples['zip_code_count'].astype('int64')
+    triples['Zip']=triples['Zip'].astype(object)
+    return triples
+
+
+def _count_changes(triples):
+    all_zips=triples.groupby('Zip').size()
+    clean=triples[triples['zip_code_count']<3].groupby('Zip').size()
+    return all_zips,clean
+
+
+# New playgrounds_by_zip and the count change per Zip (all and zip_code_count<3). Only the
+# (playground, zip code) pairs of the stale and the new rows can appear or disappear; a pair stays
+# when any playground of the updated table still gives it
+def update_relation(relation,updated,stale_rows,new_by_zip):
+    candidates=pd.concat([_triples(playground_normalize.explode_zips(stale_rows)),_triples(new_by_zip)]).drop_duplicates()
+    sources=updated[updated['id_clean'].isin(candidates['id_clean'].unique())]
+    present=_triples(playground_normalize.explode_zips(sources)).merge(candidates,on=TRIPLE)
+
+    current=_triples(relation)
+    flagged=current.merge(candidates.assign(_candidate=True),on=TRIPLE,how='left')['_candidate'].notna().to_numpy()
+    before=current[flagged]
+    result=pd.concat([relation[~flagged],present],ignore_index=True)
+
+    before_all,before_clean=_count_changes(before)
+    after_all,after_clean=_count_changes(present)
+    return result,after_all.sub(before_all,fill_value=0),after_clean.sub(before_clean,fill_value=0)
+
+
+# Playground count frame (Zip, playground_count sorted by Zip as the groupby gives it) plus changes
+def apply_count_changes(count,changes):
+    changes=changes[changes!=0]
+    if changes.empty:
+        return count
+    counts=count.set_index('Zip')['playground_count'].add(changes,fill_value=0)
+    counts=counts[counts>0].astype('int64').sort_index()
+    return counts.rename('playground_count').rename_axis('Zip').reset_index()
+
+
+def _correlation_sums(artifacts,config,bases):
+    return {name:CorrelationSums.from_table(pipeline.with_count(bases[base],artifacts[count]),'playground_count',group='County Name')
+            for name,(base,count) in pipeline.CORRELATIONS.items()}
+
+
+def _save_sums(path,sums):
+    arrays={}
+    for name,s in sums.items():
+        arrays.update({name+'.sums':s.sums,name+'.shift_x':s.shift_x,name+'.shift_y':s.shift_y,name+'.names':np.array(s.names,dtype=object)})
+    with open(path,'wb') as f:
+        np.savez(f,**arrays)
+
+
+# Features are set from the table on the first update
+def _load_sums(path):
+    with np.load(path,allow_pickle=True) as data:
+        return {name:CorrelationSums(data[name+'.sums'],data[name+'.shift_x'],data[name+'.shift_y'],list(data[name+'.names']),None)
+                for name in pipeline.CORRELATIONS}
+
+
+class PlaygroundDelta:
+
+    def __init__(self,config=None,store=None):
+        self.runner=pipeline.Pipeline(config,store)
+        self.config=self.runner.config
+        self.store=self.runner.store
+        self.state_path=os.path.join(self.store.root,STATE)
+        self.sums_path=os.path.join(self.store.root,SUMS)
+
+    # Stage keys up to the correlations for the given ingest version (source checksums)
+    def keys(self,version):
+        keys={}
+        for name in pipeline.plan(['correlation']):
+            keys[name]=self.runner.key(name,keys,version if name=='ingest' else None)
+        return keys
+
+    # Files the correlation sums were built from, any change (another pipeline run) invalidates them
+    def _fingerprints(self):
+        names=['zip_income','agi_range_pivot','playground_count','playground_count_clean']
+        return {name:pipeline._fingerprint(self.store.path(name)) for name in names}
+
+    def _state_is_current(self,keys):
+        if not (os.path.exists(self.state_path) and os.path.exists(self.sums_path)):
+            return False
+        with open(self.state_path) as f:
+            state=json.load(f)
+        return state.get('correlation_key')==keys['correlation'] and state.get('files')==json.loads(json.dumps(self._fingerprints()))
+
+    def _write_state(self,correlation_key,sums):
+        _save_sums(self.sums_path+'.tmp',sums)
+        os.replace(self.sums_path+'.tmp',self.sums_path)
+        with open(self.state_path+'.tmp','w') as f:
+            json.dump({'correlation_key':correlation_key,'files':self._fingerprints()},f,indent=1)
+        os.replace(self.state_path+'.tmp',self.state_path)
+
+    # The updated stages are current for the new ingest version, the ones after them run again
+    def _mark_current(self,version):
+        keys=self.keys(version)
+        self.runner.manifest['ingest']['version']=version
+        for name in UPDATED:
+            self.runner.manifest[name].update(key=keys[name],deps={dep:keys[dep] for dep in pipeline.STAGES[name].deps})
+        for name,stage in pipeline.STAGES.items():
+            if name not in UPDATED and set(pipeline.plan([name]))&{'playground_zip','correlation'}:
+                self.runner.manifest.pop(name,None)
+        self.runner._write_manifest()
+        return keys
+
+    # Runs the pipeline for the given ingest version, the sources are not fetched again. Given feeds
+    # replace the ones of the last ingest (run first when there is none), the other raw tables are kept
+    def _full_run(self,version,parks_raw,playgrounds_raw,start,reason):
+        if parks_raw is not None:
+            if 'ingest' not in self.runner.manifest:
+                self.runner.run(['ingest'],verbose=False)
+            version=dict(self.runner.manifest['ingest']['version'],**{name:version[name] for name in FEEDS})
+            self.store.save('parks_raw',parks_raw)
+            self.store.save('playgrounds_raw',playgrounds_raw)
+            self.runner.artifacts.frames.update(parks_raw=parks_raw,playgrounds_raw=playgrounds_raw)
+            self.runner.manifest['ingest'].update(key=self.runner.key('ingest',{},version),version=version)
+            for name in pipeline.STAGES:
+                if name!='ingest':
+                    self.runner.manifest.pop(name,None)
+            self.runner._write_manifest()
+        self.runner.run(['correlation'],verbose=False,versions={'ingest':version})
+        artifacts=self.runner.artifacts
+        self._write_state(self.runner.manifest['correlation']['key'],_correlation_sums(artifacts,self.config,pipeline.correlation_bases(artifacts,self.config)))
+        return {'mode':'full','reason':reason,'seconds':time.perf_counter()-start}
+
+    # Updates the outputs from the current feeds (downloaded with a conditional request unless given)
+    def refresh(self,parks_raw=None,playgrounds_raw=None):
+        start=time.perf_counter()
+        given=parks_raw is not None and playgrounds_raw is not None
+        last_version=self.runner.manifest.get('ingest',{}).get('version')
+        if given:
+            version=dict(last_version or {},parks=_frame_version(parks_raw),playgrounds=_frame_version(playgrounds_raw))
+        else:
+            paths,version=pipeline.fetch_sources(self.config)
+        if last_version is None or any(version[name]!=last_version.get(name) for name in pipeline.SOURCES if name not in FEEDS):
+            return self._full_run(version,parks_raw if given else None,playgrounds_raw,start,'no current pipeline run' if last_version is None else 'income sources changed')
+        keys=self.keys(last_version)
+        if not all(self.runner.is_current(name,keys[name]) for name in keys):
+            reason='code or config changed' if all(name in self.runner.manifest for name in keys) else 'no current pipeline run'
+            return self._full_run(version,parks_raw if given else None,playgrounds_raw,start,reason)
+        stats={'mode':'unchanged','added':0,'changed':0,'removed':0,'relocated':0,'zips':0}
+        if version==last_version:
+            return dict(stats,seconds=time.perf_counter()-start)
+        if not given:
+            parks_raw,playgrounds_raw=pd.read_json(paths['parks']),pd.read_json(paths['playgrounds'])
+
+        artifacts=self.runner.artifacts
+        previous=artifacts['playgrounds']
+        current,_=playground_normalize.located_playgrounds(playgrounds_raw,parks_raw)
+        columns=list(current.columns)
+        if not set(columns)<=set(previous.columns):
+            return self._full_run(version,parks_raw,playgrounds_raw,start,'new columns in the feed')
+
+        delta=diff_playgrounds(previous,current,columns)
+        changed,stale,moved,position=delta['changed'],delta['stale'],delta['moved'],delta['position'][delta['changed']]
+        stats={'mode':'delta','added':int((position<0).sum()),'changed':int((position>=0).sum()),
+               'removed':int(len(stale)-(position>=0).sum()),'relocated':int(moved.sum())}
+        if not len(changed) and not len(stale):
+            # Same records (reordered, or fields outside the playgrounds): only the version changes
+            self.store.save('parks_raw',parks_raw)
+            self.store.save('playgrounds_raw',playgrounds_raw)
+            current_sums=self._state_is_current(keys)
+            keys=self._mark_current(version)
+            if current_sums:
+                self._write_state(keys['correlation'],_load_sums(self.sums_path))
+            return dict(stats,mode='unchanged',seconds=time.perf_counter()-start)
+
+        # Zip codes and ids of the new rows only
+        rows=current.iloc[changed].copy()
+        zip_clean=pd.Series(None,index=rows.index,dtype=object)
+        zip_clean[~moved]=previous['zip_clean'].to_numpy()[position[~moved]]
+        if moved.any():
+            locator=zip_lookup.ZipLocator.from_geojson(self.config['geojson']) if rows.loc[moved,'Zip'].isna().any() else None
+            zip_clean[moved]=zip_lookup.resolve_zips(rows[moved],locator).to_numpy()
+        rows['zip_clean']=zip_clean
+        rows,new_by_zip=playground_normalize.normalize_playgrounds(rows)
+
+        # Playgrounds in feed order, the unchanged rows taken from the last run
+        order=np.argsort(np.concatenate([delta['same'],changed]),kind='stable')
+        updated=pd.concat([previous.iloc[delta['position'][delta['same']]],rows]).iloc[order]
+        updated.index=current.index
+        relation,all_changes,clean_changes=update_relation(artifacts['playgrounds_by_zip'],updated,previous.iloc[stale],new_by_zip)
+        if self.config['compact_dtypes']:
+            updated=schemas.apply_schema(updated,schemas.PLAYGROUNDS)
+            relation=schemas.apply_schema(relation,schemas.PLAYGROUNDS_BY_ZIP)
+
+        counts={'playground_count':apply_count_changes(artifacts['playground_count'],all_changes),
+                'playground_count_clean':apply_count_changes(artifacts['playground_count_clean'],clean_changes)}
+        bases=pipeline.correlation_bases(artifacts,self.config)
+        if self._state_is_current(keys):
+            sums=_load_sums(self.sums_path)
+        else:
+            sums=_correlation_sums(artifacts,self.config,bases)
+            stats['sums']='rebuilt'
+
+        zips=all_changes.index[all_changes!=0].union(clean_changes.index[clean_changes!=0])
+        outputs=dict(counts,playground_income_table_clean=pipeline.with_count(bases['zip_income_clean'],counts['playground_count_clean']))
+        for name,(base,count) in pipeline.CORRELATIONS.items():
+            table=bases[base]
+            affected=table[table[('zipcode','')].isin(zips)]
+            old=pipeline.with_count(affected,artifacts[count])
+            new=pipeline.with_count(affected,counts[count])
+            x_old=old.select_dtypes('number')
+            x_new=new.select_dtypes('number')
+            s=sums[name]
+            s.features=x_new.columns
+            s.update(s.labels(affected[('County Name','')]),x_old.to_numpy(dtype=float,na_value=np.nan),old[('playground_count','')].to_numpy(dtype=float,na_value=np.nan),
+                     x_new.to_numpy(dtype=float,na_value=np.nan),new[('playground_count','')].to_numpy(dtype=float,na_value=np.nan))
+            correlation=s.table(self.config['slices'])
+            correlation['standard deviation']=correlation.std(axis=1)
+            outputs[name]=correlation
+
+        for name,frame in dict(outputs,parks_raw=parks_raw,playgrounds_raw=playgrounds_raw,playgrounds=updated,playgrounds_by_zip=relation).items():
+            self.store.save(name,frame)
+            artifacts[name]=frame
+        self._write_state(self._mark_current(version)['correlation'],sums)
+        return dict(stats,zips=len(zips),seconds=time.perf_counter()-start)
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description='Updates the playground counts and correlations from the changes in the parks / playgrounds feeds')
+    parser.add_argument('--artifacts',default='artifacts',help='Artifact store of the pipeline')
+    parser.add_argument('--config',help='JSON file overriding DEFAULT_CONFIG')
+    args=parser.parse_args(argv)
+
+    config=None
+    if args.config:
+        with open(args.config) as f:
+            config=json.load(f)
+    stats=PlaygroundDelta(config,ArtifactStore(args.artifacts)).refresh()
+    print (', '.join('{} {}'.format(key,round(value,2) if isinstance(value,float) else value) for key,value in stats.items()))
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,53 @@
+#### Playground id and zip code normalization
+
+# Replaces the row wise generate_id apply and the split(expand=True).stack() of the playground
+# cleanup. The id of every playground is picked with one np.select over the three id columns
+# (which also keeps id_type, the row copy in generate_id lost it) and the comma separated zip
+# codes are split into one row per zip code with a flat explode instead of building a frame as
+# wide as the playground with the most zip codes.
+
+import numpy as np
+import pandas as pd
+
+
+KEY=['Prop_ID','Playground_ID','School_ID']
+
+
+# Playgrounds (one row per KEY) with the Zip of their park. Rows with neither lat/lon nor a park Zip
+# can not be placed, returns (placed, dropped)
+def located_playgrounds(playgrounds_raw,parks_raw):
+    playgrounds=playgrounds_raw.drop_duplicates(KEY)
+    playgrounds=playgrounds.merge(parks_raw[['Prop_ID','Zip']],on='Prop_ID',how='left')
+    unplaced=playgrounds[['lat','lon','Zip']].isna().all(axis=1)
+    return playgrounds[~unplaced].copy(),playgrounds[unplaced]
+
+
+# Playground_ID when there is one, else "School:"+School_ID, else "Park:"+Prop_ID
+def assign_ids(playgrounds):
+    playground_id=playgrounds['Playground_ID'].astype(object)
+    school_id=playgrounds['School_ID'].astype(object)
+    conditions=[playground_id.notna().to_numpy(),school_id.notna().to_numpy()]
+    id_clean=np.select(conditions,
+                       [playground_id.to_numpy(),('School:'+school_id.fillna('')).to_numpy()],
+                       default=('Park:'+playgrounds['Prop_ID'].astype(object).fillna('')).to_numpy())
+    id_type=np.select(conditions,['Park','School'],default='Unknown')
+    return pd.Series(id_clean,index=playgrounds.index,dtype=object),pd.Series(id_type,index=playgrounds.index,dtype=object)
+
+
+# One row per (playground, zip code) with the same columns the old stack() version produced:
+# id_clean, zip_code_count, Zip. Duplicate zip codes of a playground are removed
+def explode_zips(playgrounds):
+    by_zip=pd.DataFrame({'id_clean':playgrounds['id_clean'].to_numpy(),
+                         'zip_code_count':playgrounds['zip_code_count'].to_numpy(),
+                         'Zip':playgrounds['zip_clean'].str.split(',').to_numpy()})
+    by_zip=by_zip.explode('Zip',ignore_index=True)
+    by_zip=by_zip[by_zip['Zip'].notna()].reset_index(drop=True)
+    by_zip['Zip']=by_zip['Zip'].str.strip()
+    return by_zip.drop_duplicates()
+
+
+# Adds id_clean, id_type and zip_code_count to the playgrounds and returns the playground to zip table
+def normalize_playgrounds(playgrounds):
+    playgrounds['id_clean'],playgrounds['id_type']=assign_ids(playgrounds)
+    playgrounds['zip_code_count']=playgrounds['zip_clean'].str.count(',')+1        #Calculates number of zips per playground
+    return playgrounds,explode_zips(playgrounds)
@@ -0,0 +1,176 @@
+#### Distance based playground access for zip codes (or any set of points)
+
+# The playground count of a zip code only counts playgrounds whose zip string matches, so a big
+# park listed under several zip codes counts fully in each of them (hence the zip_code_count<3
+# filter) and a playground across the street from a zip code border does not count at all. Here
+# the playgrounds are put in a KD-tree (scipy cKDTree) and every query point (zip code centroid,
+# or random points inside every zip code polygon) gets in one batched query:
+#
+#   nearest_km_1..k  - distance to the k nearest playgrounds
+#   within_<r>km     - playgrounds within r km
+#   access_score     - sum over playgrounds of exp(-d^2/(2*bandwidth^2)), a playground next to the
+#                      point counts 1 and its weight fades with distance (cut off at 3 bandwidths)
+#
+# Points are placed on the unit sphere so chord distances in the tree are exact great circle
+# distances at any scale. The nearest and within queries use every core (workers=-1), the
+# access_score pair search is single threaded and runs in chunks, so millions of query points
+# (census blocks) only need memory for one chunk of point pairs at a time.
+
+import json
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from zip_lookup import _contains
+
+EARTH_RADIUS_KM=6371.0088
+RADII_KM=(0.5,1.0)
+BANDWIDTH_KM=0.8
+NEAREST=3
+CHUNK=50000             # Query points per access_score pass, bounds the memory of the point pairs
+
+
+def _unit_vectors(lat,lon):
+    lat=np.radians(np.asarray(lat,dtype=float))
+    lon=np.radians(np.asarray(lon,dtype=float))
+    return np.column_stack([np.cos(lat)*np.cos(lon),np.cos(lat)*np.sin(lon),np.sin(lat)])
+
+
+def _chord(km):
+    return 2*np.sin(np.minimum(np.asarray(km,dtype=float)/EARTH_RADIUS_KM,np.pi)/2)
+
+
+def _km(chord):
+    return 2*EARTH_RADIUS_KM*np.arcsin(np.clip(chord/2,0,1))
+
+
+class ProximityIndex:
+
+    def __init__(self,lat,lon,weights=None,leafsize=32,workers=-1):
+        lat=np.asarray(lat,dtype=float)
+        lon=np.asarray(lon,dtype=float)
+        valid=~(np.isnan(lat)|np.isnan(lon))
+        self.dropped=int((~valid).sum())          # Points without coordinates can not be placed
+        self.weights=np.ones(valid.sum()) if weights is None else np.asarray(weights,dtype=float)[valid]
+        self.tree=cKDTree(_unit_vectors(lat[valid],lon[valid]),leafsize=leafsize)
+        self.workers=workers
+
+    def __len__(self):
+        return self.tree.n
+
+    # Distance in km to the k nearest points, shape (queries, k). inf when there are fewer than k points
+    def nearest(self,lat,lon,k=NEAREST):
+        chord,_=self.tree.query(_unit_vectors(lat,lon),k=[i+1 for i in range(k)],workers=self.workers)
+        return np.where(np.isinf(chord),np.inf,_km(chord))
+
+    # Number of points within radius_km of every query point
+    def count_within(self,lat,lon,radius_km):
+        return self.tree.query_ball_point(_unit_vectors(lat,lon),_chord(radius_km),return_length=True,workers=self.workers)
+
+    # Gaussian distance weighted sum of the point weights around every query point
+    def access_score(self,lat,lon,bandwidth_km=BANDWIDTH_KM,cutoff=3.0,chunk=CHUNK):
+        points=_unit_vectors(lat,lon)
+        score=np.zeros(len(points))
+        for first in range(0,len(points),chunk):
+            block=cKDTree(points[first:first+chunk])
+            pairs=block.sparse_distance_matrix(self.tree,_chord(cutoff*bandwidth_km),output_type='ndarray')
+            kernel=np.exp(-0.5*(_km(pairs['v'])/bandwidth_km)**2)*self.weights[pairs['j']]
+            score[first:first+chunk]+=np.bincount(pairs['i'],weights=kernel,minlength=len(block.data))
+        return score
+
+    # All the metrics for a set of query points as a frame. A missing k-th playground (fewer than k
+    # in the index) is NaN, not inf, so means and correlations skip it
+    def metrics(self,lat,lon,radii_km=RADII_KM,k=NEAREST,bandwidth_km=BANDWIDTH_KM):
+        columns={}
+        if k:
+            for i,distances in enumerate(self.nearest(lat,lon,k).T):
+                columns['nearest_km_{}'.format(i+1)]=np.where(np.isinf(distances),np.nan,distances)
+        for radius in radii_km:
+            columns['within_{:g}km'.format(radius)]=self.count_within(lat,lon,radius)
+        columns['access_score']=self.access_score(lat,lon,bandwidth_km)
+        return pd.DataFrame(columns)
+
+
+def _features(geojson):
+    if isinstance(geojson,str):
+        with open(geojson,'r') as jsonFile:
+            geojson=json.load(jsonFile)
+    return geojson['features']
+
+
+def _polygons(geometry):
+    return [geometry['coordinates']] if geometry['type']=='Polygon' else geometry['coordinates']
+
+
+# Area weighted centroid of every zip code, one row per zip code. The polygons of all the features
+# of a zip code (the islands and pieces split across several features) are combined, holes subtracted
+def zip_centroids(geojson,key='postalCode'):
+    sums={}
+    for feature in _features(geojson):
+        total,cx,cy=sums.setdefault(str(feature['properties'][key]),[0.0,0.0,0.0])
+        for polygon in _polygons(feature['geometry']):
+            for position,ring in enumerate(polygon):
+                ring=np.asarray(ring,dtype=float)[:,:2]
+                x,y=ring[:,0],ring[:,1]
+                cross=x[:-1]*y[1:]-x[1:]*y[:-1]
+                area=cross.sum()/2
+                sign=1 if position==0 else -1          # Holes count negative whatever their orientation
+                area_abs=sign*abs(area)
+                if area:
+                    total+=area_abs
+                    cx+=area_abs*((x[:-1]+x[1:])*cross).sum()/(6*area)
+                    cy+=area_abs*((y[:-1]+y[1:])*cross).sum()/(6*area)
+        sums[str(feature['properties'][key])]=[total,cx,cy]
+    rows=[(zip_code,cy/total if total else np.nan,cx/total if total else np.nan) for zip_code,(total,cx,cy) in sums.items()]
+    return pd.DataFrame(rows,columns=['Zip','lat','lon'])
+
+
+# Random points inside every feature, about `per_km2` per square km and at least `minimum` per
+# polygon. The points of all the features of a zip code carry the same Zip
+def polygon_samples(geojson,per_km2=20,minimum=5,seed=0,key='postalCode'):
+    rng=np.random.default_rng(seed)
+    zips,lats,lons=[],[],[]
+    for feature in _features(geojson):
+        for polygon in _polygons(feature['geometry']):
+            outer=np.asarray(polygon[0],dtype=float)[:,:2]
+            parts=[outer]
+            for ring in polygon[1:]:                  # Holes as in zip_lookup.ZipLocator.from_geojson
+                parts.append(np.asarray(ring,dtype=float)[:,:2])
+                parts.append(outer[:1])
+            vertices=np.concatenate(parts)
+            (x0,y0),(x1,y1)=outer.min(axis=0),outer.max(axis=0)
+            km2=abs(np.sum(outer[:-1,0]*outer[1:,1]-outer[1:,0]*outer[:-1,1]))/2*111.32**2*np.cos(np.radians((y0+y1)/2))
+            wanted=max(minimum,int(round(km2*per_km2)))
+            kept=np.empty((0,2))
+            for _ in range(20):                       # Rejection sampling from the bounding box
+                if len(kept)>=wanted:
+                    break
+                candidates=np.column_stack([rng.uniform(x0,x1,wanted*2),rng.uniform(y0,y1,wanted*2)])
+                kept=np.concatenate([kept,candidates[_contains(vertices,candidates[:,0],candidates[:,1])]])
+            kept=kept[:wanted]
+            zips.extend([str(feature['properties'][key])]*len(kept))
+            lons.extend(kept[:,0])
+            lats.extend(kept[:,1])
+    return pd.DataFrame({'Zip':zips,'lat':lats,'lon':lons})
+
+
+# Proximity metrics of every zip code of the geojson (a path or the loaded dict), one row per zip
+# code even when it is split across several features. At the centroid
+# by default, or averaged over random points inside the zip code with samples_per_km2 (closer to
+# what the people living there see). Playgrounds without lat/lon only have a park zip code and
+# are left out
+def zip_proximity(playgrounds,geojson,radii_km=RADII_KM,k=NEAREST,bandwidth_km=BANDWIDTH_KM,samples_per_km2=None,seed=0):
+    if isinstance(geojson,str):
+        geojson={'features':_features(geojson)}
+    located=playgrounds.drop_duplicates('id_clean') if 'id_clean' in playgrounds else playgrounds
+    index=ProximityIndex(pd.to_numeric(located['lat'],errors='coerce'),pd.to_numeric(located['lon'],errors='coerce'))
+    centroids=zip_centroids(geojson)
+    if not samples_per_km2:
+        return pd.concat([centroids,index.metrics(centroids['lat'],centroids['lon'],radii_km,k,bandwidth_km)],axis=1)
+    points=polygon_samples(geojson,samples_per_km2,seed=seed)
+    metrics=index.metrics(points['lat'],points['lon'],radii_km,k,bandwidth_km)
+    metrics.insert(0,'Zip',points['Zip'].to_numpy())
+    metrics['sample_points']=1
+    result=metrics.groupby('Zip',sort=False).agg({**{c:'mean' for c in metrics.columns[1:-1]},'sample_points':'sum'})
+    return centroids.merge(result.reset_index(),on='Zip',how='left')
@@ -0,0 +1,174 @@
+#### Compact dtypes for the income and playground frames
+
+# The income frames carried float64 for every number and a County Name string on every bracket
+# row. The schemas below give each column the smallest dtype that holds it:
+#
+#   category  - County Name, playground Status / Accessible / id_type
+#   int32     - zip codes, uint8 for agi_stub
+#   Int32     - return counts (N1, mars1, MARS2, MARS4 and their sums). Nullable, so a missing
+#               count stays missing instead of forcing float64. Signed because N1-calc_total_returns
+#               is taken on them
+#   float32   - ratios and averages (weights, weighted averages, individual AGI, std). Dollar
+#               totals (A00100, hoh_total_agi) stay float64, they are summed again later
+#
+# apply_schema checks every cast: integer casts must not round or overflow, float32 casts must
+# stay within `rtol` of the original values and a column that does not fit raises ValueError, so
+# the metrics computed from compact frames are the ones computed from the originals.
+# compare_metrics checks two versions of a result frame against each other, 'python schemas.py'
+# does that for the whole income and correlation path on synthetic data and prints the memory saved
+# and the time of both. The casts cost more than the smaller frames save in the groupbys and merges
+# (national scale: 5.5s against 4.9s), so the pipeline only applies the schemas with compact_dtypes
+# on, for runs that are short of memory.
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+RTOL=1e-6
+
+COUNTS=['N1','mars1','MARS2','MARS4','calc_total_returns']
+RATIOS=['num_of_returns_error','weight','hoh_weight','median_return','weighted_avg_agi','hoh_weighted_avg_agi',
+        'individual_agi','mode_individual_agi','median_range','median_individual_agi',
+        'weighted_avg_capita','hoh_weighted_avg_capita','simple_average','hoh_simple_average']
+
+# Raw IRS rows (income_tax_raw)
+INCOME={'zipcode':'int32','agi_stub':'uint8',**{name:'Int32' for name in COUNTS}}
+
+# Bracket level frame (nyc_bracket_level) and zip code frame (zip_income). Tuple keys match a
+# column exactly, a plain name matches every column whose first level is that name
+BRACKETS={**INCOME,'County Name':'category','ZIP Code':'int32',
+          ('N1','sum'):'Int32',('N1','max'):'Int32',('MARS4','sum'):'Int32',
+          ('N1','mean'):'float32',('N1','var'):'float32',('N1','std'):'float32',
+          **{name:'float32' for name in RATIOS}}
+ZIPS={label:dtype for label,dtype in BRACKETS.items() if label!='zipcode'}      # zipcode is the str key of the maps and merges here
+
+# Bracket pivot (agi_range_pivot): returns per agi_stub
+AGI_RANGE={'County Name':'category','N1':'Int32','MARS4':'Int32'}
+
+PLAYGROUNDS={'Status':'category','Accessible':'category','Adaptive_Swing':'category','id_type':'category',
+             'Level':'UInt8','zip_code_count':'UInt8'}
+PLAYGROUNDS_BY_ZIP={'zip_code_count':'UInt8'}
+
+
+def _dtype_for(schema,label):
+    if label in schema:
+        return schema[label]
+    if isinstance(label,tuple) and label and label[0] in schema:
+        return schema[label[0]]
+    return None
+
+
+def _cast(series,dtype,rtol,label):
+    dtype=pd.api.types.pandas_dtype(dtype)
+    if isinstance(dtype,pd.CategoricalDtype):
+        return series.astype('category')
+
+    numeric=series if pd.api.types.is_numeric_dtype(series) else pd.to_numeric(series)
+    values=numeric.to_numpy(dtype=float,na_value=np.nan)
+    present=~np.isnan(values)
+    if dtype.kind in 'iu':
+        nullable=isinstance(dtype,pd.api.extensions.ExtensionDtype)
+        info=np.iinfo(dtype.numpy_dtype if nullable else dtype)
+        kept=values[present]
+        if not np.array_equal(kept,np.round(kept)):
+            raise ValueError('{}: {} would round non integer values'.format(label,dtype))
+        if len(kept) and (kept.min()<info.min or kept.max()>info.max):
+            raise ValueError('{}: values outside the {} range'.format(label,dtype))
+        if not nullable and not present.all():
+            raise ValueError('{}: {} can not hold missing values'.format(label,dtype))
+        return numeric.astype(dtype)
+
+    cast=values.astype(dtype)
+    if not np.allclose(cast,values,rtol=rtol,atol=0,equal_nan=True):
+        raise ValueError('{}: {} changes values by more than rtol={}'.format(label,dtype,rtol))
+    return pd.Series(cast,index=series.index)
+
+
+# Copy of the frame with the schema dtypes. Columns not in the schema keep their dtype
+def apply_schema(frame,schema,rtol=RTOL):
+    columns={}
+    for position,label in enumerate(frame.columns):
+        dtype=_dtype_for(schema,label)
+        series=frame.iloc[:,position]
+        if dtype is not None and series.dtype!=dtype:
+            columns[position]=_cast(series,dtype,rtol,label)
+    if not columns:
+        return frame
+    frame=frame.copy(deep=False)
+    for position,series in columns.items():
+        frame.isetitem(position,series)
+    return frame
+
+
+def memory_mb(frame):
+    return frame.memory_usage(deep=True).sum()/1024**2
+
+
+# Labels of the columns that differ between two versions of a result frame. Numbers are compared
+# with `rtol`/`atol` (NaN equal to NaN), everything else as strings
+def compare_metrics(reference,candidate,rtol=1e-5,atol=1e-12):
+    differences=[label for label in reference.columns if label not in candidate.columns]
+    for label in reference.columns:
+        if label not in candidate.columns:
+            continue
+        left=reference[label]
+        right=candidate[label]
+        if pd.api.types.is_numeric_dtype(left) and pd.api.types.is_numeric_dtype(right):
+            a=left.to_numpy(dtype=float,na_value=np.nan)
+            b=right.to_numpy(dtype=float,na_value=np.nan)
+            same=len(a)==len(b) and np.allclose(a,b,rtol=rtol,atol=atol,equal_nan=True)
+        else:
+            same=left.astype(str).tolist()==right.astype(str).tolist()
+        if not same:
+            differences.append(label)
+    return differences
+
+
+# Runs the income and correlation stages on synthetic data with and without the compact dtypes,
+# prints the memory and time of both and checks that every metric matches
+def main(argv=None):
+    import pipeline
+    import synthetic_data
+
+    parser=argparse.ArgumentParser(description='Checks that the compact dtypes give the same metrics and shows the memory saved')
+    parser.add_argument('--scale',default='national',choices=list(synthetic_data.SCALES))
+    args=parser.parse_args(argv)
+
+    data=synthetic_data.generate(args.scale)
+    results={}
+    with tempfile.TemporaryDirectory(prefix='schemas_') as directory:
+        config=dict(pipeline.DEFAULT_CONFIG,counties=data.pop('counties'),
+                    geojson=synthetic_data.write_geojson(data.pop('geojson'),os.path.join(directory,'zips.geojson')))
+        for compact in (False,True):
+            artifacts=dict(data)
+            stage_config=dict(config,compact_dtypes=compact)
+            start=time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for stage in (pipeline.playground_zip,pipeline.income_metrics,pipeline.correlation):
+                    artifacts.update(stage(artifacts,stage_config))
+            results[compact]=(artifacts,time.perf_counter()-start)
+
+    failed=False
+    print ('{:<42}{:>12}{:>12}{:>8}'.format('frame','float64 MB','compact MB','ratio'))
+    for name in ['nyc_bracket_level','zip_income','agi_range_pivot','playgrounds','playgrounds_by_zip',
+                 'income_playground_correl_no_filters','outliers_excluding_correlation']:
+        reference=results[False][0][name]
+        candidate=results[True][0][name]
+        # Correlations near zero only keep an absolute precision from float32 inputs
+        differences=compare_metrics(reference,candidate,atol=1e-5 if 'correl' in name else 1e-12)
+        failed=failed or bool(differences)
+        print ('{:<42}{:>12.1f}{:>12.1f}{:>8.1f}  {}'.format(name,memory_mb(reference),memory_mb(candidate),
+            memory_mb(reference)/memory_mb(candidate),'differs: '+str(differences) if differences else 'same'))
+    print ('playground_zip + income_metrics + correlation: {:.2f}s -> {:.2f}s'.format(results[False][1],results[True][1]))
+    return 1 if failed else 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+#### Synthetic parks, playgrounds, zip codes and IRS brackets at a configurable scale
+
+# Produces the same raw tables the ingest stage reads (parks_raw, playgrounds_raw,
+# income_tax_raw, ny_zips_raw) plus a zip code geojson, for NYC sized data up to ten times the
+# national zip code count, so the pipeline stages can be timed at sizes the real files never
+# reach. The zip codes are cells of a square grid whose shared borders wiggle (identically from
+# both sides) so the border simplification has something to do. Parks carry a zip code list for
+# most rows like the DPR file and the rest of the playgrounds need the point in polygon lookup.
+
+import json
+
+import numpy as np
+import pandas as pd
+
+NYC_COUNTIES=['New York','Queens','Richmond','Kings','Bronx']
+SCALES={
+    'nyc':{'zips':180,'counties':5,'edge_points':8},
+    'state':{'zips':1800,'counties':62,'edge_points':4},
+    'national':{'zips':27700,'counties':3100,'edge_points':2},
+    '10x':{'zips':277000,'counties':31000,'edge_points':1},
+}
+PARKS_PER_ZIP=11
+PLAYGROUNDS_PER_ZIP=7
+CELL_SIZE=0.01
+ORIGIN=(-74.25,40.5)
+BRACKET_AGI=[12.5,37.5,62.5,87.5,150,400]       # Typical AGI per return of every agi_stub, in thousands
+
+
+# Offset of the inner points of a grid edge, zero at both corners. `edge` identifies the edge so
+# the two cells sharing it compute the same points
+def _wiggle(t,edge,amplitude):
+    return amplitude*np.sin(np.pi*t)*((edge*7919%13)/6.0-1.0)
+
+
+# One closed counter clockwise ring per grid cell, shape (cells, 4*edge_points+1, 2)
+def _cell_rings(columns,rows,grid_columns,edge_points,cell_size=CELL_SIZE,origin=ORIGIN):
+    m=edge_points
+    t=np.arange(m)/m
+    c=columns[:,None].astype(float)
+    r=rows[:,None].astype(float)
+    amplitude=0.1*cell_size
+    horizontal=lambda row: (row*(grid_columns+1)+columns)[:,None]                 # Edge ids, unique per grid line segment
+    vertical=lambda column: (10**9+rows*(grid_columns+1)+column)[:,None]
+
+    bottom_x=origin[0]+(c+t)*cell_size
+    bottom_y=origin[1]+r*cell_size+_wiggle(t,horizontal(rows),amplitude)
+    right_x=origin[0]+(c+1)*cell_size+_wiggle(t,vertical(columns+1),amplitude)
+    right_y=origin[1]+(r+t)*cell_size
+    top_t=(m-np.arange(m))/m
+    top_x=origin[0]+(c+top_t)*cell_size
+    top_y=origin[1]+(r+1)*cell_size+_wiggle(top_t,horizontal(rows+1),amplitude)
+    left_x=origin[0]+c*cell_size+_wiggle(top_t,vertical(columns),amplitude)
+    left_y=origin[1]+(r+top_t)*cell_size
+
+    x=np.concatenate([bottom_x,right_x,top_x,left_x,bottom_x[:,:1]],axis=1)
+    y=np.concatenate([bottom_y,right_y,top_y,left_y,bottom_y[:,:1]],axis=1)
+    return np.stack([x,y],axis=2)
+
+
+# Random points well inside the given grid cells (away from the wiggling borders)
+def _points_in_cells(rng,cells,grid_columns,cell_size=CELL_SIZE,origin=ORIGIN):
+    u=rng.uniform(0.2,0.8,size=(len(cells),2))
+    lon=origin[0]+(cells%grid_columns+u[:,0])*cell_size
+    lat=origin[1]+(cells//grid_columns+u[:,1])*cell_size
+    return lat,lon
+
+
+# Raw tables for one scale, keyed like the ingest stage outputs plus 'geojson' (a FeatureCollection)
+# and 'counties' (the county names to pass as the pipeline 'counties' setting)
+def generate(scale='nyc',seed=0):
+    spec=SCALES[scale] if isinstance(scale,str) else scale
+    rng=np.random.default_rng(seed)
+    n_zips=spec['zips']
+    grid_columns=int(np.ceil(np.sqrt(n_zips)))
+    cells=np.arange(n_zips)
+    zip_codes=(10001+cells).astype(str).astype(object)
+
+    # Counties are contiguous blocks of zip codes, the first five carry the NYC names so the
+    # default No_Manhattan slice of correl_table exists at every scale
+    county_index=cells*spec['counties']//n_zips
+    county_names=np.array(NYC_COUNTIES[:spec['counties']]+['County {:05d}'.format(i) for i in range(len(NYC_COUNTIES),spec['counties'])],dtype=object)
+    ny_zips_raw=pd.DataFrame({'County Name':county_names[county_index],'ZIP Code':10001+cells})
+
+    rings=_cell_rings(cells%grid_columns,cells//grid_columns,grid_columns,spec['edge_points'])
+    geojson={'type':'FeatureCollection',
+             'features':[{'type':'Feature','properties':{'postalCode':code},'geometry':{'type':'Polygon','coordinates':[ring]}}
+                         for code,ring in zip(zip_codes,np.round(rings,7).tolist())]}
+
+    # Parks: one home cell each. Most list their zip code (some with a neighbour too), 15% have none
+    n_parks=n_zips*PARKS_PER_ZIP
+    park_cell=rng.integers(0,n_zips,n_parks)
+    neighbour=np.clip(park_cell+rng.choice([1,-1,grid_columns,-grid_columns],n_parks),0,n_zips-1)
+    kind=rng.random(n_parks)
+    park_zip=np.where(kind<0.70,zip_codes[park_cell],
+             np.where(kind<0.85,zip_codes[park_cell]+', '+zip_codes[neighbour],None))
+    park_ids=np.char.add('X',np.char.zfill(np.arange(n_parks).astype(str),7)).astype(object)
+    parks_raw=pd.DataFrame({'Prop_ID':park_ids,'Zip':park_zip})
+
+    # Playgrounds: in a park's cell. Playground_ID for most, School_ID for some, neither for a few
+    n_playgrounds=n_zips*PLAYGROUNDS_PER_ZIP
+    park=rng.integers(0,n_parks,n_playgrounds)
+    lat,lon=_points_in_cells(rng,park_cell[park],grid_columns)
+    missing=rng.random(n_playgrounds)<0.01
+    lat[missing]=np.nan
+    lon[missing]=np.nan
+    kind=rng.random(n_playgrounds)
+    serial=np.char.zfill(np.arange(n_playgrounds).astype(str),8).astype(object)
+    playgrounds_raw=pd.DataFrame({'Prop_ID':park_ids[park],
+                                  'Playground_ID':np.where(kind<0.80,park_ids[park]+'-'+serial,None),
+                                  'School_ID':np.where((kind>=0.80)&(kind<0.98),'S'+serial,None),
+                                  'lat':lat,'lon':lon})
+
+    # IRS brackets: six agi_stub rows per zip code
+    n_rows=n_zips*6
+    n1=rng.integers(50,5000,n_rows).astype(float)
+    mars4=np.floor(n1*rng.uniform(0.05,0.3,n_rows))
+    mars1=np.floor((n1-mars4)*rng.uniform(0.4,0.7,n_rows))
+    agi_stub=np.tile(np.arange(1,7),n_zips)
+    income_tax_raw=pd.DataFrame({'zipcode':np.repeat(10001+cells,6).astype('int32'),
+                                 'agi_stub':agi_stub.astype('int8'),
+                                 'N1':n1,'mars1':mars1,'MARS2':n1-mars1-mars4,'MARS4':mars4,
+                                 'A00100':np.round(n1*np.array(BRACKET_AGI)[agi_stub-1]*rng.lognormal(0,0.25,n_rows))})
+
+    return {'parks_raw':parks_raw,'playgrounds_raw':playgrounds_raw,'income_tax_raw':income_tax_raw,
+            'ny_zips_raw':ny_zips_raw,'geojson':geojson,
+            'counties':NYC_COUNTIES[:spec['counties']]+(['County'] if spec['counties']>len(NYC_COUNTIES) else [])}
+
+
+def write_geojson(geojson,path):
+    with open(path,'w') as jsonFile:
+        json.dump(geojson,jsonFile,separators=(',',':'))
+    return path
@@ -0,0 +1,153 @@
+#### Offline reverse geocoding of playgrounds to zip codes
+
+# Replaces the per row Google reverse geocode call (the old get_zip). The zip code borders are
+# loaded once from the geojson in the Original Data folder and every polygon is placed into
+# grid buckets using its bounding box. A whole array of lat/lon points is resolved in one
+# call: each point only gets tested against the polygons sharing its grid cell.
+
+import json
+
+import numpy as np
+import pandas as pd
+
+GEOJSON_PATH='Original Data/nyc_zip_code.geojson'
+
+
+class ZipLocator:
+
+    def __init__(self,zips,rings,cell_size=0.01,snap_tolerance=0.002):
+        self.zips=np.asarray(zips,dtype=object)
+        self.rings=[np.asarray(ring,dtype=float) for ring in rings]     # One array of (lon,lat) vertices per polygon
+        self.cell_size=cell_size
+        self.snap_tolerance=snap_tolerance                             # Points just outside every border (piers, shore lines) snap to the closest border within this many degrees
+
+        bounds=np.array([[r[:,0].min(),r[:,1].min(),r[:,0].max(),r[:,1].max()] for r in self.rings])
+        self.bounds=bounds
+        self.area=(bounds[:,2]-bounds[:,0])*(bounds[:,3]-bounds[:,1])
+        self.origin=bounds[:,:2].min(axis=0)
+        self.shape=(np.floor((bounds[:,2:].max(axis=0)-self.origin)/cell_size).astype(int)+1)
+
+        # Grid buckets: cell -> polygons whose bounding box touches that cell (stored CSR style)
+        cells=[]
+        polys=[]
+        for i,(x0,y0,x1,y1) in enumerate(bounds):
+            cx0,cy0=self._cell(np.array([x0]),np.array([y0]))
+            cx1,cy1=self._cell(np.array([x1]),np.array([y1]))
+            gx,gy=np.meshgrid(np.arange(cx0[0],cx1[0]+1),np.arange(cy0[0],cy1[0]+1))
+            cells.append((gx*self.shape[1]+gy).ravel())
+            polys.append(np.full(gx.size,i))
+        cells=np.concatenate(cells)
+        polys=np.concatenate(polys)
+        order=np.argsort(cells,kind='stable')
+        self.bucket_polys=polys[order]
+        self.bucket_start=np.searchsorted(cells[order],np.arange(self.shape[0]*self.shape[1]+1))
+
+    @classmethod
+    def from_geojson(cls,path=GEOJSON_PATH,key='postalCode',**kwargs):
+        with open(path,'r') as jsonFile:
+            data=json.load(jsonFile)
+
+        zips=[]
+        rings=[]
+        for feature in data['features']:
+            geometry=feature['geometry']
+            polygons=[geometry['coordinates']] if geometry['type']=='Polygon' else geometry['coordinates']
+            for polygon in polygons:
+                # All rings of a polygon are kept in one vertex list. Every inner ring is followed by a
+                # jump back to the outer ring start so the connecting edges cancel out, and the
+                # even-odd rule then treats the inner rings as holes
+                outer=np.asarray(polygon[0],dtype=float)[:,:2]
+                parts=[outer]
+                for ring in polygon[1:]:
+                    parts.append(np.asarray(ring,dtype=float)[:,:2])
+                    parts.append(outer[:1])
+                vertices=np.concatenate(parts)
+                zips.append(str(feature['properties'][key]))
+                rings.append(vertices)
+        return cls(zips,rings,**kwargs)
+
+    def _cell(self,lon,lat):
+        cx=np.floor((lon-self.origin[0])/self.cell_size).astype(int)
+        cy=np.floor((lat-self.origin[1])/self.cell_size).astype(int)
+        return cx,cy
+
+    # Returns the index of the polygon containing every point (-1 when no polygon contains it)
+    def locate(self,lat,lon):
+        lat=np.asarray(lat,dtype=float)
+        lon=np.asarray(lon,dtype=float)
+        result=np.full(lat.shape,-1)
+
+        cx,cy=self._cell(lon,lat)
+        valid=(cx>=0)&(cy>=0)&(cx<self.shape[0])&(cy<self.shape[1])
+        points=np.flatnonzero(valid)
+        cell=cx[points]*self.shape[1]+cy[points]
+
+        # Expand every point into (point,candidate polygon) pairs
+        counts=self.bucket_start[cell+1]-self.bucket_start[cell]
+        pair_point=np.repeat(points,counts)
+        offsets=np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts,counts)
+        pair_poly=self.bucket_polys[np.repeat(self.bucket_start[cell],counts)+offsets]
+
+        # Bounding box filter before the exact test
+        b=self.bounds[pair_poly]
+        inside_box=(lon[pair_point]>=b[:,0])&(lon[pair_point]<=b[:,2])&(lat[pair_point]>=b[:,1])&(lat[pair_point]<=b[:,3])
+        pair_point=pair_point[inside_box]
+        pair_poly=pair_poly[inside_box]
+
+        # Exact point in polygon test, one vectorized ray cast per candidate polygon. Building zip codes
+        # sit inside bigger zip codes so polygons are tested from largest to smallest and the most
+        # specific match wins
+        candidates=np.unique(pair_poly)
+        for poly in candidates[np.argsort(-self.area[candidates],kind='stable')]:
+            pts=pair_point[pair_poly==poly]
+            inside=_contains(self.rings[poly],lon[pts],lat[pts])
+            result[pts[inside]]=poly
+
+        if self.snap_tolerance:
+            for pt in np.flatnonzero(valid&(result==-1)):
+                result[pt]=self._nearest(lon[pt],lat[pt])
+        return result
+
+    # Closest polygon border (by vertex) to a point that fell outside every polygon
+    def _nearest(self,lon,lat):
+        tol=self.snap_tolerance
+        near=np.flatnonzero((self.bounds[:,0]-tol<=lon)&(self.bounds[:,2]+tol>=lon)&(self.bounds[:,1]-tol<=lat)&(self.bounds[:,3]+tol>=lat))
+        best=-1
+        best_distance=tol
+        for poly in near:
+            distance=np.hypot(self.rings[poly][:,0]-lon,self.rings[poly][:,1]-lat).min()
+            if distance<=best_distance:
+                best,best_distance=poly,distance
+        return best
+
+    # Returns the zip code for every point as a string (None when the point is outside NYC)
+    def lookup(self,lat,lon):
+        index=self.locate(lat,lon)
+        zips=self.zips[np.where(index>=0,index,0)]
+        zips[index<0]=None
+        return zips
+
+
+# Even-odd ray casting of many points against one polygon
+def _contains(ring,x,y):
+    x0=ring[:-1,0][None,:]
+    y0=ring[:-1,1][None,:]
+    x1=ring[1:,0][None,:]
+    y1=ring[1:,1][None,:]
+    x=x[:,None]
+    y=y[:,None]
+    crosses=(y0>y)!=(y1>y)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        x_cross=x0+(y-y0)*(x1-x0)/(y1-y0)
+    return (crosses&(x<x_cross)).sum(axis=1)%2==1
+
+
+# Batch version of the old get_zip: keeps the Zip from the parks data when there is one and
+# resolves the rest of the rows from lat/lon in a single call
+def resolve_zips(playgrounds,locator):
+    zip_clean=playgrounds['Zip'].astype(object).copy()
+    missing=zip_clean.isna().to_numpy()
+    if missing.any():
+        rows=playgrounds[missing]
+        zip_clean[missing]=locator.lookup(pd.to_numeric(rows['lat']).to_numpy(),pd.to_numeric(rows['lon']).to_numpy())
+    return zip_clean
@@ -0,0 +1,453 @@
+#### Local HTTP / JSON query service for the per zip code metrics
+
+# Other teams need a few zip code numbers (weighted_avg_capita, hoh_total_agi, the playground
+# count, ...) and used to re-run the script or parse the csv files. ZipIndex loads zip_income and
+# playground_count from the artifact store once into one float array (zip codes x metrics, rows in
+# zip code order) with a dict from zip code to row, so a query is a dict lookup and an array slice:
+#
+#   GET  /zip/10001?metrics=weighted_avg_capita,playground_count       one zip code
+#   GET  /zips?zip=10001,10002&metrics=...                              several zip codes
+#   POST /zips  {"zips":["10001","10002"],"metrics":[...]}
+#   GET  /aggregate?county=Bronx&from=10400&to=10499&stats=mean,max    count / sum / mean / min /
+#                                                                       max (default) / median over
+#                                                                       a county and / or zip code range
+#   GET  /metrics                                                       metric names, counties, version
+#
+# Metrics are the flattened column names of the artifact store ('N1__sum', 'hoh_total_agi__sum'),
+# a name with one aggregate only can be given without it ('hoh_total_agi'). Missing values are
+# null. Every aggregate is a contiguous segment of the rows (zip code order, or county then zip code
+# order), count / sum / mean come from prefix sums and min / max from per block values, so they do
+# not read the segment; median does. Aggregates are also kept in an LRU cache (cache_size entries)
+# that belongs to the loaded index.
+#
+# ZipService checks the pipeline manifest at most every check_interval seconds and loads a new
+# index once the pipeline (or playground_delta.py) wrote both tables of a run. Queries keep using
+# the old index until the new one is complete, then the reference is swapped.
+#
+# Usage: python zip_service.py [--artifacts artifacts] [--port 8765]
+#        python zip_service.py --latency [--synthetic nyc]     in process p50 / p99 of the queries
+
+import argparse
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from artifact_store import ArtifactStore, flatten_columns
+
+HOST='127.0.0.1'
+PORT=8765
+INCOME='zip_income'
+COUNT='playground_count'
+MANIFEST='pipeline_manifest.json'
+PRODUCERS={INCOME:'income_metrics','playground_count':'correlation','playground_count_clean':'correlation'}      # Pipeline stage of every table
+CACHE_SIZE=1024
+CHECK_INTERVAL=1.0          # Seconds between two checks of the artifact files
+STATS=('count','sum','mean','min','max','median')
+DEFAULT_STATS=('count','sum','mean','min','max')         # median reads every row of the segment, only on request
+BLOCK=64                # Rows per min / max block of an aggregate layout
+
+
+def _zip(value):
+    return str(value).strip()
+
+
+# Floats with NaN as None, ready for json
+def _values(array):
+    return [None if value!=value else value for value in array.tolist()]
+
+
+# Rows of the zip code table in one order, with prefix sums of the present values and of their
+# count (row i holds the totals of the rows before i), so a segment total is one subtraction, and
+# the min / max of every BLOCK rows. The totals are float64 differences, exact for counts and within
+# rounding for the dollar sums
+class _Segments:
+
+    def __init__(self,values,zips):
+        self.values=values
+        self.zips=zips
+        present=~np.isnan(values)
+        self.count=np.zeros((len(values)+1,values.shape[1]),dtype=np.int64)
+        np.cumsum(present,axis=0,out=self.count[1:])
+        self.sum=np.zeros((len(values)+1,values.shape[1]))
+        np.cumsum(np.where(present,values,0.0),axis=0,out=self.sum[1:])
+        padded=np.full((-(-len(values)//BLOCK)*BLOCK,values.shape[1]),np.nan)
+        padded[:len(values)]=values
+        padded=padded.reshape(-1,BLOCK,values.shape[1])
+        self.blocks={'min':np.fmin.reduce(padded,axis=1),'max':np.fmax.reduce(padded,axis=1)}
+
+    # min or max of every column over [first, last): the rows of the two partial blocks and the
+    # block totals in between. NaN only when the column is all NaN there
+    def extreme(self,stat,first,last):
+        reduce=(np.fmin if stat=='min' else np.fmax).reduce
+        if last-first<=2*BLOCK:
+            return reduce(self.values[first:last],axis=0)
+        inner_first,inner_last=-(-first//BLOCK),last//BLOCK
+        blocks=self.blocks[stat][inner_first:inner_last]
+        return reduce(np.vstack([self.values[first:inner_first*BLOCK],blocks,self.values[inner_last*BLOCK:last]]),axis=0)
+
+    # [first, last) narrowed to the zip codes from start to end (inclusive), the zip codes of a
+    # segment are sorted
+    def narrow(self,first,last,start,end):
+        zips=self.zips[first:last]
+        low=first if start is None else first+int(np.searchsorted(zips,start,side='left'))
+        high=last if end is None else first+int(np.searchsorted(zips,end,side='right'))
+        return low,max(low,high)
+
+
+class ZipIndex:
+
+    def __init__(self,zip_income,playground_count,version=None,cache_size=CACHE_SIZE):
+        income=zip_income.reset_index(drop=True)
+        names=flatten_columns(income.columns)
+        income_zips=income.iloc[:,names.index('zipcode')].map(_zip).to_numpy()
+        numeric=[i for i,dtype in enumerate(income.dtypes) if pd.api.types.is_numeric_dtype(dtype) and names[i]!='zipcode']
+        count=playground_count.groupby(playground_count['Zip'].map(_zip))['playground_count'].sum()
+
+        self.zips=np.array(sorted(set(income_zips)|set(count.index)))
+        rows=pd.Index(self.zips).get_indexer(income_zips)
+        self.metrics=[names[i] for i in numeric]+[COUNT]
+        self.values=np.full((len(self.zips),len(self.metrics)),np.nan)
+        for j,i in enumerate(numeric):
+            self.values[rows,j]=income.iloc[:,i].to_numpy(dtype=float,na_value=np.nan)
+        # Zip codes of zip_income without playgrounds have 0 playgrounds, the others are unknown
+        self.values[rows,-1]=0.0
+        self.values[pd.Index(self.zips).get_indexer(count.index),-1]=count.to_numpy(dtype=float)
+
+        county=np.full(len(self.zips),None,dtype=object)
+        if 'County Name' in names:
+            county[rows]=income.iloc[:,names.index('County Name')].astype(object).where(lambda c:c.notna(),None).to_numpy()
+        self.county=county
+        self.row={zip_code:i for i,zip_code in enumerate(self.zips)}
+
+        # Every aggregate is one contiguous segment of a layout: zip code order for ranges, county
+        # then zip code order for a county (or a range inside it)
+        codes,names_by_code=pd.factorize(county)
+        order=np.argsort(codes,kind='stable')
+        self._by_zip=_Segments(self.values,self.zips)
+        self._by_county=_Segments(self.values[order],self.zips[order])
+        starts=np.searchsorted(codes[order],np.arange(len(names_by_code)+1))
+        self.counties={name:(int(starts[i]),int(starts[i+1])) for i,name in enumerate(names_by_code)}
+
+        self.column={name:j for j,name in enumerate(self.metrics)}
+        short={}
+        for name in self.metrics:
+            short.setdefault(name.split('__')[0],[]).append(name)
+        for name,full in short.items():
+            if len(full)==1 and name not in self.column:
+                self.column[name]=self.column[full[0]]
+        self.version=version
+        self.loaded_at=time.time()
+        self._aggregate=functools.lru_cache(maxsize=cache_size)(self._compute_aggregate)
+
+    @classmethod
+    def from_store(cls,store,count=COUNT,version=None,cache_size=CACHE_SIZE):
+        return cls(store.load(INCOME),store.load(count),version,cache_size)
+
+    # Column positions and names of the requested metrics (all when None)
+    def _columns(self,metrics):
+        if not metrics:
+            return list(range(len(self.metrics))),self.metrics
+        unknown=[name for name in metrics if name not in self.column]
+        if unknown:
+            raise KeyError('unknown metric(s): '+', '.join(unknown))
+        return [self.column[name] for name in metrics],list(metrics)
+
+    def _record(self,i,columns,names):
+        return {'zip':str(self.zips[i]),'county':self.county[i],**dict(zip(names,_values(self.values[i,columns])))}
+
+    # One zip code, None when it is not in the tables
+    def point(self,zip_code,metrics=None):
+        columns,names=self._columns(metrics)
+        i=self.row.get(_zip(zip_code))
+        return None if i is None else self._record(i,columns,names)
+
+    # One record per zip code in the order given, {'zip':..., 'found':False} for unknown ones
+    def batch(self,zip_codes,metrics=None):
+        columns,names=self._columns(metrics)
+        zip_codes=[_zip(zip_code) for zip_code in zip_codes]
+        rows=[self.row.get(zip_code) for zip_code in zip_codes]
+        found=[i for i in rows if i is not None]
+        block=self.values[np.ix_(found,columns)] if found else np.empty((0,len(columns)))
+        records=iter(zip(found,block))
+        result=[]
+        for zip_code,i in zip(zip_codes,rows):
+            if i is None:
+                result.append({'zip':zip_code,'found':False})
+                continue
+            row,values=next(records)
+            result.append({'zip':zip_code,'county':self.county[row],**dict(zip(names,_values(values)))})
+        return result
+
+    # Stats of the metrics over the zip codes of a county and / or an inclusive zip code range.
+    # The result is cached, do not change it
+    def aggregate(self,county=None,start=None,end=None,metrics=None,stats=DEFAULT_STATS):
+        unknown=[stat for stat in stats if stat not in STATS]
+        if unknown:
+            raise ValueError('unknown stat(s): '+', '.join(unknown))
+        if county is not None and county not in self.counties:
+            raise KeyError('unknown county: '+str(county))
+        self._columns(metrics)
+        return self._aggregate(county,None if start is None else _zip(start),None if end is None else _zip(end),
+                               tuple(metrics or ()),tuple(stats))
+
+    # count / sum / mean come from the prefix sums, min / max from the block totals, median reads
+    # the whole segment
+    def _compute_aggregate(self,county,start,end,metrics,stats):
+        columns,names=self._columns(metrics)
+        layout,(first,last)=(self._by_zip,(0,len(self.zips))) if county is None else (self._by_county,self.counties[county])
+        first,last=layout.narrow(first,last,start,end)
+        count=layout.count[last,columns]-layout.count[first,columns]
+        result={'county':county,'from':start,'to':end,'zips':last-first,'stats':{}}
+        for stat in stats:
+            if stat=='count':
+                values=count.astype(float)
+            elif stat=='sum':
+                values=layout.sum[last,columns]-layout.sum[first,columns]
+            elif stat=='mean':
+                values=np.where(count>0,(layout.sum[last,columns]-layout.sum[first,columns])/np.maximum(count,1),np.nan)
+            elif last==first:
+                values=np.full(len(columns),np.nan)
+            elif stat=='median':
+                segment=layout.values[first:last]
+                values=np.array([np.median(column[~np.isnan(column)]) if n else np.nan for column,n in zip(segment[:,columns].T,count)])
+            else:
+                values=layout.extreme(stat,first,last)[columns]
+            result['stats'][stat]=dict(zip(names,_values(values)))
+        return result
+
+    def cache_info(self):
+        return self._aggregate.cache_info()._asdict()
+
+    def describe(self):
+        return {'version':self.version,'loaded_at':self.loaded_at,'zips':len(self.zips),
+                'metrics':self.metrics,'counties':sorted(self.counties),'stats':list(STATS),'cache':self.cache_info()}
+
+
+# The current ZipIndex of an artifact store, reloaded when the pipeline wrote new tables. The
+# tables come from two stages (zip_income from income_metrics, the playground counts from
+# correlation, which runs later), so the reload is keyed on their pipeline manifest entries and
+# only happens once the correlation entry was built on the current income_metrics entry. A store
+# without a manifest (tables saved by hand) is keyed on the files instead
+class ZipService:
+
+    def __init__(self,store,count=COUNT,cache_size=CACHE_SIZE,check_interval=CHECK_INTERVAL,manifest=MANIFEST):
+        self.store=store
+        self.names=[INCOME,count]
+        self.count=count
+        self.cache_size=cache_size
+        self.check_interval=check_interval
+        self.manifest_path=os.path.join(store.root,manifest)
+        self.reloads=0
+        self._lock=threading.Lock()
+        self._checked=time.monotonic()
+        self._signature=self._current()
+        self._index=self._load(self._signature)
+
+    def _path(self,name):
+        path=self.store.path(name,'arrow')
+        return path if os.path.exists(path) else self.store.path(name,'parquet')
+
+    # (mtime, size, inode) of the artifact files, the store replaces a file instead of writing into it
+    def _files(self):
+        signature=[]
+        for name in self.names:
+            stat=os.stat(self._path(name))
+            signature.append((stat.st_mtime_ns,stat.st_size,stat.st_ino))
+        return tuple(signature)
+
+    # Keys of the income_metrics and correlation entries, None while a pipeline run is between
+    # the two (or has not reached them)
+    def _current(self):
+        if not os.path.exists(self.manifest_path):
+            return self._files()
+        with open(self.manifest_path) as f:
+            manifest=json.load(f)
+        income,correlation=manifest.get(PRODUCERS[INCOME]),manifest.get(PRODUCERS[self.count])
+        if income is None or correlation is None or correlation.get('deps',{}).get(PRODUCERS[INCOME])!=income['key']:
+            return None
+        return (income['key'],correlation['key'])
+
+    def _load(self,signature):
+        version=None
+        if signature:
+            version=signature[1][:12] if isinstance(signature[1],str) else max(mtime for mtime,_,_ in signature)
+        return ZipIndex.from_store(self.store,self.count,version=version,cache_size=self.cache_size)
+
+    # Loads a new index when a consistent pair of tables was written. While a run is under way, or
+    # when the tables changed again during the load (or the load failed), the old index is kept and
+    # the next check tries again
+    def reload(self,force=False):
+        with self._lock:
+            self._checked=time.monotonic()
+            try:
+                signature=self._current()
+                if signature is None or (signature==self._signature and not force):
+                    return False
+                index=self._load(signature)
+                if self._current()!=signature:
+                    return False
+            except (OSError,ValueError,KeyError) as error:
+                print ('zip_service: reload failed, keeping version {} ({})'.format(self._index.version,error),file=sys.stderr)
+                return False
+            self._index=index
+            self._signature=signature
+            self.reloads+=1
+            return True
+
+    @property
+    def index(self):
+        if time.monotonic()-self._checked>=self.check_interval:
+            self.reload()
+        return self._index
+
+
+def _split(values):
+    return [value for item in values for value in item.split(',') if value]
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    service=None
+    verbose=False
+
+    def _send(self,status,body):
+        data=json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _answer(self,path,query,body=None):
+        index=self.service.index
+        metrics=_split(query.get('metrics',[])) or (body or {}).get('metrics')
+        parts=[unquote(part) for part in path.strip('/').split('/')]
+        if parts[0]=='zip' and len(parts)==2:
+            record=index.point(parts[1],metrics)
+            return (200,record) if record is not None else (404,{'error':'unknown zip code: '+parts[1]})
+        if parts==['zips']:
+            zip_codes=_split(query.get('zip',[])) or (body or {}).get('zips') or []
+            return 200,{'results':index.batch(zip_codes,metrics)}
+        if parts==['aggregate']:
+            first=lambda name:query.get(name,[None])[0]
+            return 200,index.aggregate(first('county'),first('from'),first('to'),metrics,_split(query.get('stats',[])) or DEFAULT_STATS)
+        if parts==['metrics']:
+            return 200,dict(index.describe(),reloads=self.service.reloads)
+        return 404,{'error':'unknown path: '+path}
+
+    def _handle(self,body=None):
+        url=urlsplit(self.path)
+        try:
+            status,result=self._answer(url.path,parse_qs(url.query),body)
+        except (KeyError,ValueError) as error:
+            status,result=400,{'error':error.args[0] if error.args else str(error)}
+        self._send(status,result)
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        try:
+            body=json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        except ValueError:
+            return self._send(400,{'error':'body is not valid json'})
+        self._handle(body if isinstance(body,dict) else {'zips':body})
+
+    def log_message(self,format,*args):
+        if self.verbose:
+            super().log_message(format,*args)
+
+
+def make_server(service,host=HOST,port=PORT,verbose=False):
+    handler=type('ZipHandler',(Handler,),{'service':service,'verbose':verbose})
+    return ThreadingHTTPServer((host,port),handler)
+
+
+# In process latency of point, batch (50 zip codes) and aggregate queries in milliseconds. Every
+# 'aggregate' query is a new county / zip code range (a cache miss), 'aggregate_cached' repeats a
+# few of them like a dashboard would. 'aggregate_median' (new ranges, median only) grows with the
+# size of the range and is not held to the 1 ms target
+def measure_latency(index,queries=5000,seed=0):
+    rng=np.random.default_rng(seed)
+    zips=index.zips
+    counties=[None]+sorted(index.counties)
+    metrics=[None,['weighted_avg_capita','hoh_total_agi',COUNT]]
+
+    def new_aggregate(i,stats=DEFAULT_STATS):
+        county=counties[rng.integers(len(counties))]
+        start,end=sorted(rng.choice(zips,2)) if i%3 else (None,None)
+        return index.aggregate(county,start,end,metrics[i%2],stats)
+
+    repeated=[(counties[i%len(counties)],*sorted(rng.choice(zips,2))) for i in range(20)]
+    kinds={'point':lambda i:index.point(zips[rng.integers(len(zips))],metrics[i%2]),
+           'batch':lambda i:index.batch(rng.choice(zips,50),metrics[i%2]),
+           'aggregate':new_aggregate,
+           'aggregate_cached':lambda i:index.aggregate(*repeated[i%len(repeated)],metrics[i%2]),
+           'aggregate_median':lambda i:new_aggregate(i,('median',))}
+    result={}
+    for name,query in kinds.items():
+        misses=index.cache_info()['misses']
+        times=np.empty(queries)
+        for i in range(queries):
+            began=time.perf_counter()
+            query(i)
+            times[i]=time.perf_counter()-began
+        result[name]={'p50_ms':float(np.percentile(times,50)*1000),'p99_ms':float(np.percentile(times,99)*1000),
+                      'max_ms':float(times.max()*1000),'cache_misses':index.cache_info()['misses']-misses}
+    return result
+
+
+def _synthetic_index(scale):
+    import tempfile
+    import lodha
+    with tempfile.TemporaryDirectory(prefix='zip_service_') as directory:
+        inputs,config=lodha.synthetic_inputs(scale,directory)
+        results=lodha.compute(['income_metrics','correlation'],config,inputs)
+    return ZipIndex(results['zip_income'],results[COUNT])
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description='Serves the per zip code income metrics and playground counts as JSON')
+    parser.add_argument('--artifacts',default='artifacts',help='Artifact store of the pipeline')
+    parser.add_argument('--host',default=HOST)
+    parser.add_argument('--port',type=int,default=PORT)
+    parser.add_argument('--count',default=COUNT,choices=['playground_count','playground_count_clean'],help='Playground count artifact')
+    parser.add_argument('--cache-size',type=int,default=CACHE_SIZE,help='Cached aggregates')
+    parser.add_argument('--check-interval',type=float,default=CHECK_INTERVAL,help='Seconds between checks for new artifacts')
+    parser.add_argument('--latency',action='store_true',help='Print the in process query latency and exit')
+    parser.add_argument('--synthetic',help='With --latency: use synthetic data of this scale instead of the artifacts')
+    parser.add_argument('--queries',type=int,default=5000)
+    parser.add_argument('--verbose',action='store_true',help='Log every request')
+    args=parser.parse_args(argv)
+
+    if args.latency:
+        index=_synthetic_index(args.synthetic) if args.synthetic else ZipIndex.from_store(ArtifactStore(args.artifacts),args.count,cache_size=args.cache_size)
+        result=measure_latency(index,args.queries)
+        print ('{} zip codes, {} metrics'.format(len(index.zips),len(index.metrics)))
+        print ('{:<18}{:>10}{:>10}{:>10}{:>14}'.format('query','p50 ms','p99 ms','max ms','cache misses'))
+        for name,r in result.items():
+            print ('{:<18}{:>10.3f}{:>10.3f}{:>10.3f}{:>14}'.format(name,r['p50_ms'],r['p99_ms'],r['max_ms'],r['cache_misses']))
+        return 1 if any(r['p99_ms']>=1.0 for name,r in result.items() if name!='aggregate_median') else 0
+
+    service=ZipService(ArtifactStore(args.artifacts),args.count,args.cache_size,args.check_interval)
+    server=make_server(service,args.host,args.port,args.verbose)
+    print ('Serving {} zip codes on http://{}:{}'.format(len(service.index.zips),args.host,args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main())